@@ -74,9 +74,9 @@ class DataGenerator:
         generator.manual_seed(args.seed)
 
         dataloader['train'] = DataLoader(train_ds, batch_size=args.b,
-                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, collate_fn=local_views_collate, **worker_kwargs(args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=args.b,
-                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, collate_fn=local_views_collate, **worker_kwargs(args.workers))
         return dataloader
 
     def cluster_luna_pretask(self, load_gt=True):
@@ -99,9 +99,9 @@ class DataGenerator:
         generator.manual_seed(args.seed)
 
         dataloader['train'] = DataLoader(train_ds, batch_size=args.b,
-                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, **worker_kwargs(args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=args.b,
-                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, **worker_kwargs(args.workers))
         return dataloader
 
     def pcrlv2_brats_pretask(self):
@@ -120,9 +120,9 @@ class DataGenerator:
         generator.manual_seed(args.seed)
 
         dataloader['train'] = DataLoader(train_ds, batch_size=args.b,
-                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, collate_fn=local_views_collate, **worker_kwargs(args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=args.b,
-                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, collate_fn=local_views_collate, **worker_kwargs(args.workers))
         return dataloader
 
     def cluster_brats_pretask(self, load_gt=True):
@@ -141,9 +141,9 @@ class DataGenerator:
         generator.manual_seed(args.seed)
 
         dataloader['train'] = DataLoader(train_ds, batch_size=args.b,
-                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, **worker_kwargs(args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=args.b,
-                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, **worker_kwargs(args.workers))
         return dataloader
 
     def pcrlv2_lits_pretask(self):
@@ -165,9 +165,9 @@ class DataGenerator:
         generator.manual_seed(args.seed)
 
         dataloader['train'] = DataLoader(train_ds, batch_size=args.b,
-                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, collate_fn=local_views_collate, **worker_kwargs(args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=args.b,
-                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, collate_fn=local_views_collate, **worker_kwargs(args.workers))
         return dataloader
 
     def cluster_lits_pretask(self, load_gt=True):
@@ -191,9 +191,9 @@ class DataGenerator:
         generator.manual_seed(args.seed)
 
         dataloader['train'] = DataLoader(train_ds, batch_size=args.b,
-                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                         pin_memory=True, shuffle=True, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, **worker_kwargs(args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=args.b,
-                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator)
+                                        pin_memory=True, shuffle=False, num_workers=args.workers, worker_init_fn=seed_worker, generator=generator, **worker_kwargs(args.workers))
         return dataloader
  
 
@@ -215,13 +215,15 @@ class DataGenerator:
                                          worker_init_fn=seed_worker,
                                          generator=generator,
                                          pin_memory=True,
-                                         shuffle=True)
+                                         shuffle=True,
+                                         **worker_kwargs(self.args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=self.args.b,
                                         num_workers=self.args.workers,
                                         worker_init_fn=seed_worker,
                                         generator=generator,
                                         pin_memory=True,
-                                        shuffle=False)
+                                        shuffle=False,
+                                        **worker_kwargs(self.args.workers))
         dataloader['test'] = DataLoader(test_ds, batch_size=1, num_workers=self.args.b,
                                         worker_init_fn=seed_worker,
                                         generator=generator,
@@ -247,13 +249,15 @@ class DataGenerator:
                                          worker_init_fn=seed_worker,
                                          generator=generator,
                                          pin_memory=True,
-                                         shuffle=True)
+                                         shuffle=True,
+                                         **worker_kwargs(self.args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=self.args.b,
                                         num_workers=self.args.workers,
                                         worker_init_fn=seed_worker,
                                         generator=generator,
                                         pin_memory=True,
-                                        shuffle=False)
+                                        shuffle=False,
+                                        **worker_kwargs(self.args.workers))
         dataloader['test'] = DataLoader(test_ds, batch_size=1, num_workers=self.args.b,
                                         worker_init_fn=seed_worker,
                                         generator=generator,
@@ -280,13 +284,15 @@ class DataGenerator:
                                          worker_init_fn=seed_worker,
                                          generator=generator,
                                          pin_memory=True,
-                                         shuffle=True)
+                                         shuffle=True,
+                                         **worker_kwargs(self.args.workers))
         dataloader['eval'] = DataLoader(valid_ds, batch_size=self.args.b,
                                         num_workers=self.args.workers,
                                         worker_init_fn=seed_worker,
                                         generator=generator,
                                         pin_memory=True,
-                                        shuffle=False)
+                                        shuffle=False,
+                                        **worker_kwargs(self.args.workers))
         dataloader['test'] = DataLoader(test_ds, batch_size=1, num_workers=self.args.b,
                                         worker_init_fn=seed_worker,
                                         generator=generator,
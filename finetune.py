@@ -11,7 +11,7 @@ from copy import deepcopy
 import PIL
 import cv2
 
-from tools import prepare_model, get_loss, dice_coeff
+from tools import prepare_model, get_loss, dice_coeff, AsyncCheckpointer
 from torch.utils.tensorboard import SummaryWriter
 import torchvision.transforms.functional as t
 
@@ -37,7 +37,7 @@ def train_segmentation(args, dataloader, in_channels, n_classes, run_dir, writer
         model = model.cuda()
 
     # Loss
-    criterion = get_loss(args.n)
+    criterion = get_loss(args.n, getattr(torch, args.loss_dtype), args.debug)
  
     # Optimizer
     if args.model == 'genesis':
@@ -55,6 +55,8 @@ def train_segmentation(args, dataloader, in_channels, n_classes, run_dir, writer
 
     grid_pred = []  # Grid for visualizing predictions at each epoch
 
+    checkpointer = AsyncCheckpointer()  # Save best models without blocking training on disk writes
+
     for epoch in range(0, args.epochs + 1):
         train_losses = []
         valid_losses = []
@@ -238,7 +240,7 @@ def train_segmentation(args, dataloader, in_channels, n_classes, run_dir, writer
             print("Validation loss decreases from {:.4f} to {:.4f}".format(best_loss, valid_loss))
             best_loss = valid_loss
             num_epoch_no_improvement = 0
-            torch.save({
+            checkpointer.save({
                 'epoch': epoch + 1,
                 'state_dict': model.module.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict()
@@ -258,6 +260,8 @@ def train_segmentation(args, dataloader, in_channels, n_classes, run_dir, writer
 
         sys.stdout.flush()
 
+    checkpointer.wait()  # The best model must be on disk before testing loads it
+
     return writer
 
 
@@ -270,7 +274,7 @@ def test_segmentation(args, dataloader, in_channels, n_classes, writer=None):
     if not args.cpu:
         model = model.cuda()
 
-    criterion = get_loss(args.n)
+    criterion = get_loss(args.n, getattr(torch, args.loss_dtype), args.debug)
 
     test_loss_arr = []
     test_dice_arr = []
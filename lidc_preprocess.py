@@ -23,20 +23,17 @@ with open(os.path.join(os.path.expanduser('~'),'.pylidcrc'), 'w') as file:
 
 paths = []
 
-for folder_path, _, file_names in os.walk(root_folder):
-    rel_folder_path = os.path.relpath(folder_path,root_folder)
-    depth = rel_folder_path.count(os.path.sep)
+# Only the top-level patient folders are needed, so read the root folder once instead of walking the whole DICOM tree
+pids = sorted(entry.name for entry in os.scandir(root_folder) if entry.is_dir() and 'LIDC-IDRI' in entry.name)
 
-    if depth == 0 and 'LIDC-IDRI' in rel_folder_path:
-        pid = rel_folder_path.split('/')[-1]
-
-        if not overwrite:
-            mask_file = pid.replace('-','_') + '_raw.npy'
-            seg_file = pid.replace('-','_') + '_seg.npy'
-            if not os.path.exists(os.path.join(save_folder, pid, mask_file)) or not os.path.exists((os.path.join(save_folder, pid, seg_file))):
-                paths.append(pid)
-        if overwrite:
+for pid in pids:
+    if not overwrite:
+        mask_file = pid.replace('-','_') + '_raw.npy'
+        seg_file = pid.replace('-','_') + '_seg.npy'
+        if not os.path.exists(os.path.join(save_folder, pid, mask_file)) or not os.path.exists((os.path.join(save_folder, pid, seg_file))):
             paths.append(pid)
+    if overwrite:
+        paths.append(pid)
 
 # Save images and segmentation masks as .npy files
 for pid in tqdm(paths):
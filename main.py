@@ -5,7 +5,7 @@ import warnings
 from train_2d import train_pcrlv2_2d, train_cluster_2d
 from train_3d import train_pcrlv2_3d, train_cluster_3d
 from data import get_dataloader
-from tools import set_seed, create_logger
+from tools import set_seed, create_logger, init_distributed
 from finetune import train_lidc_segmentation, test_lidc_segmentation, train_brats_segmentation, test_brats_segmentation, train_lits_segmentation, test_lits_segmentation
 
 
@@ -35,14 +35,24 @@ if __name__ == '__main__':
     parser.add_argument('--weight', default=None, type=str, help='Diretory to weights to load')
     parser.add_argument('--weight_decay', default=1e-4)
     parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--deterministic', action='store_true', default=False, help='To use deterministic (reproducible but slower) cuDNN algorithms and no TF32 or not')
     parser.add_argument('--patience', default=None, type=int)
     parser.add_argument('--amp', action='store_true', default=False)
+    parser.add_argument('--amp_dtype', default='bfloat16', choices=['bfloat16', 'float16'], type=str, help='Precision of the mixed-precision (--amp) 3D pretask training (float16 uses loss scaling, bfloat16 recommended on Ampere or newer GPUs)')
+    parser.add_argument('--loss_dtype', default='float32', choices=['float32', 'bfloat16', 'float16'], type=str, help='Precision of the segmentation loss computation, with autocast (bfloat16 recommended on Ampere or newer GPUs, float16 can overflow)')
+    parser.add_argument('--fuse_crops', action='store_true', default=False, help='To run both crops through the 3D PCRLv2 model in a single forward (faster, but batch norm statistics are shared by the crops) or not')
+    parser.add_argument('--channels_last', action='store_true', default=False, help='To use the channels-last (NDHWC) memory format for the 3D pretask models and inputs (faster 3D convs on tensor-core GPUs, best with --amp) or not')
+    parser.add_argument('--grad_ckpt', action='store_true', default=False, help='To use activation checkpointing in the 3D pretask models (less memory, about one more forward of compute) or not')
+    parser.add_argument('--compile', action='store_true', default=False, help='To compile hot functions (e.g. sinkhorn) with torch.compile or not')
     parser.add_argument('--skip_conn', action='store_true', default=False, help='To include skip connections in the U-Net or not. Ideally, use False for pretrain and True for finetune')
     parser.add_argument('--k', default=10, type=int, help='Number of clusters for clustering pretask')
     parser.add_argument('--upsampler', default='featup', choices=['featup', 'interp'], type=str, help='Choose upsampler that produced the ground truth for dino pixel-level clustering')
     parser.add_argument('--tensorboard', action='store_true', default=False, help='To log on tensorboard or not')
     parser.add_argument('--vis', action='store_true', default=False, help='To visualize by logging prediction images on tensorboard')
+    parser.add_argument('--vis_every', default=1, type=int, help='Every how many epochs to log the training prediction images (with --vis)')
     parser.add_argument('--cpu', action='store_true', default=False, help='To run on CPU or not')
+    parser.add_argument('--debug', action='store_true', default=False, help='To print the segmentation loss values of every step (each print waits for the GPU) or not')
+    parser.add_argument('--verbose', action='store_true', default=False, help='To print the names of pretrained, finetuned and frozen parameters or not')
     args = parser.parse_args()
     if not os.path.exists(args.output):
         os.makedirs(args.output)
@@ -52,9 +62,15 @@ if __name__ == '__main__':
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
 
     # Set seed
-    set_seed(args.seed)
+    set_seed(args.seed, args.deterministic)
     print(f'Seed is {args.seed}\n')
 
+    # Join the process group if launched with torchrun (e.g. torchrun --nproc_per_node=4 main.py ...), only the 3D pretask trains distributed
+    if args.phase == 'pretask' and args.d == 3:
+        init_distributed(args)
+    else:
+        assert 'LOCAL_RANK' not in os.environ, 'Launching with torchrun is only supported for the 3D pretask'
+
     data_loader = get_dataloader(args)
 
     # Force or assert arguments
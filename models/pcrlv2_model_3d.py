@@ -1,6 +1,8 @@
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class LUConv(nn.Module):
     def __init__(self, in_chan, out_chan, act, norm):
@@ -33,6 +35,31 @@ class LUConv(nn.Module):
         return out
 
 
+def _run(block, *args, **kwargs):
+    return block(*args, **kwargs)
+
+
+@contextlib.contextmanager
+def _keep_bn_stats(block):
+    # The recompute runs the BatchNorm layers of the block in train mode again, so restore their running stats (and batch count) afterwards:
+    # they are then updated once per step, as without checkpointing, and the pretrained weights get the same statistics
+    bns = [m for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, count) in zip(bns, saved):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(count)
+
+
+def _run_checkpointed(block, *args, **kwargs):
+    # Activation checkpointing: keep only the block input and recompute the block activations in the backward
+    return checkpoint(block, *args, use_reentrant=False, context_fn=lambda: (contextlib.nullcontext(), _keep_bn_stats(block)), **kwargs)
+
+
 def _make_nConv(in_channel, depth, act, norm, double_chnnel=False):
     if double_chnnel:
         layer1 = LUConv(in_channel, 32 * (2 ** (depth + 1)), act, norm)
@@ -113,34 +140,39 @@ class PCRLv23d(nn.Module):
         self.out_tr = OutputTransition(64, n_class)
         self.sigmoid = nn.Sigmoid()
         self.skip_conn=skip_conn
+        self.grad_ckpt = False  # Activation checkpointing of the encoder/decoder blocks while training
 
     def forward(self, x, local=False):
 
+        run = _run_checkpointed if self.grad_ckpt and self.training and torch.is_grad_enabled() else _run
+
         # Encoder
-        self.skip_out64 = self.down_tr64(x)
-        self.skip_out128 = self.down_tr128(self.maxpool(self.skip_out64))
-        self.skip_out256 = self.down_tr256(self.maxpool(self.skip_out128))
-        self.out512 = self.down_tr512(self.maxpool(self.skip_out256))
+        self.skip_out64 = run(self.down_tr64, x)
+        self.skip_out128 = run(self.down_tr128, self.maxpool(self.skip_out64))
+        self.skip_out256 = run(self.down_tr256, self.maxpool(self.skip_out128))
+        self.out512 = run(self.down_tr512, self.maxpool(self.skip_out256))
 
         # Decoder
         middle_masks = []
         middle_features = []
         if self.skip_conn:
-            out_up_256, pro_256, pre_256, middle_masks_256 = self.up_tr256(self.out512, skip_x=self.skip_out256)
+            out_up_256, pro_256, pre_256, middle_masks_256 = run(self.up_tr256, self.out512, skip_x=self.skip_out256)
         else:
-            out_up_256, pro_256, pre_256, middle_masks_256 = self.up_tr256(self.out512)
+            out_up_256, pro_256, pre_256, middle_masks_256 = run(self.up_tr256, self.out512)
         if self.skip_conn:
-            out_up_128, pro_128, pre_128, middle_masks_128 = self.up_tr128(out_up_256, skip_x=self.skip_out128)
+            out_up_128, pro_128, pre_128, middle_masks_128 = run(self.up_tr128, out_up_256, skip_x=self.skip_out128)
         else:
-            out_up_128, pro_128, pre_128, middle_masks_128 = self.up_tr128(out_up_256)
+            out_up_128, pro_128, pre_128, middle_masks_128 = run(self.up_tr128, out_up_256)
         if self.skip_conn:
-            out_up_64, pro_64, pre_64, middle_masks_64 = self.up_tr64(out_up_128, skip_x=self.skip_out64)
+            out_up_64, pro_64, pre_64, middle_masks_64 = run(self.up_tr64, out_up_128, skip_x=self.skip_out64)
         else:
-            out_up_64, pro_64, pre_64, middle_masks_64 = self.up_tr64(out_up_128)
+            out_up_64, pro_64, pre_64, middle_masks_64 = run(self.up_tr64, out_up_128)
         if not local:
             middle_masks.append(F.interpolate(middle_masks_256, scale_factor=4, mode='trilinear'))
             middle_masks.append(F.interpolate(middle_masks_128, scale_factor=2, mode='trilinear'))
             middle_masks.append(middle_masks_64)
+        else:  # Not needed for the local views, but returned (without upsampling) so that every forward reaches the same parameters (for DistributedDataParallel)
+            middle_masks.extend([middle_masks_256, middle_masks_128, middle_masks_64])
         middle_features.append([pro_256, pre_256])
         middle_features.append([pro_128, pre_128])
         middle_features.append([pro_64, pre_64])
@@ -165,28 +197,31 @@ class Cluster3d(nn.Module):
         self.out_tr = OutputTransition(64, n_clusters)
         self.sigmoid = nn.Sigmoid()
         self.skip_conn=skip_conn
+        self.grad_ckpt = False  # Activation checkpointing of the encoder/decoder blocks while training
 
     def forward(self, x):
 
+        run = _run_checkpointed if self.grad_ckpt and self.training and torch.is_grad_enabled() else _run
+
         # Encoder
-        self.skip_out64 = self.down_tr64(x)
-        self.skip_out128 = self.down_tr128(self.maxpool(self.skip_out64))
-        self.skip_out256 = self.down_tr256(self.maxpool(self.skip_out128))
-        self.out512 = self.down_tr512(self.maxpool(self.skip_out256))
+        self.skip_out64 = run(self.down_tr64, x)
+        self.skip_out128 = run(self.down_tr128, self.maxpool(self.skip_out64))
+        self.skip_out256 = run(self.down_tr256, self.maxpool(self.skip_out128))
+        self.out512 = run(self.down_tr512, self.maxpool(self.skip_out256))
 
         # Decoder
         if self.skip_conn:
-            out_up_256, _, _, _ = self.up_tr256(self.out512, skip_x=self.skip_out256)
+            out_up_256, _, _, _ = run(self.up_tr256, self.out512, skip_x=self.skip_out256)
         else:
-            out_up_256, _, _, _ = self.up_tr256(self.out512)
+            out_up_256, _, _, _ = run(self.up_tr256, self.out512)
         if self.skip_conn:
-            out_up_128, _, _, _ = self.up_tr128(out_up_256, skip_x=self.skip_out128)
+            out_up_128, _, _, _ = run(self.up_tr128, out_up_256, skip_x=self.skip_out128)
         else:
-            out_up_128, _, _, _ = self.up_tr128(out_up_256)
+            out_up_128, _, _, _ = run(self.up_tr128, out_up_256)
         if self.skip_conn:
-            out_up_64, _, _, _ = self.up_tr64(out_up_128, skip_x=self.skip_out64)
+            out_up_64, _, _, _ = run(self.up_tr64, out_up_128, skip_x=self.skip_out64)
         else:
-            out_up_64, _, _, _ = self.up_tr64(out_up_128)
+            out_up_64, _, _, _ = run(self.up_tr64, out_up_128)
 
         # Output Layer
         out = self.out_tr(out_up_64)
@@ -204,6 +239,7 @@ class ClusterPatch3d(nn.Module):
         self.down_tr256 = DownTransition(128, 2, act, norm)
         self.down_tr512 = DownTransition(256, 3, act, norm)
         self.sigmoid = nn.Sigmoid()
+        self.grad_ckpt = False  # Activation checkpointing of the encoder blocks while training
 
         # Clustering Pretask Head
         self.emb_dim = 64  # E
@@ -215,11 +251,13 @@ class ClusterPatch3d(nn.Module):
 
     def forward(self, x):
 
+        run = _run_checkpointed if self.grad_ckpt and self.training and torch.is_grad_enabled() else _run
+
         # Encoder
-        skip_out64 = self.down_tr64(x)
-        skip_out128 = self.down_tr128(self.maxpool(skip_out64))
-        skip_out256 = self.down_tr256(self.maxpool(skip_out128))
-        out512 = self.down_tr512(self.maxpool(skip_out256))
+        skip_out64 = run(self.down_tr64, x)
+        skip_out128 = run(self.down_tr128, self.maxpool(skip_out64))
+        skip_out256 = run(self.down_tr256, self.maxpool(skip_out128))
+        out512 = run(self.down_tr512, self.maxpool(skip_out256))
 
 
         # Flatten spatial dims HP, WP, DP of feature map (B x CP x HP x WP x DP -> B x CP x NP) and bring channel dim to the end -> (B x NP x CP)
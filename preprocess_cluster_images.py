@@ -9,6 +9,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
 import sys
 import random
 import csv
+import shutil
 
 import numpy as np
 import SimpleITK as sitk
@@ -329,14 +330,11 @@ def luna_preprocess():
     
     # Combine csv files
     save_path = config.SAVE_DIR
-    final_file = open(os.path.join(save_path,f'crop_coords.csv'), 'w', newline='\n')
-    writer = csv.writer(final_file)
-    files = [open(os.path.join(save_path,f'crop_coords_{i}.csv'), 'r', newline='\n') for i in range(10)]
-    for file in files:
-        reader = csv.reader(file)
-        for row in reader:
-            writer.writerow(row)
-    final_file.close()
+    # (The fold files are already csv formatted, so they are copied in blocks instead of being parsed and rewritten row by row)
+    with open(os.path.join(save_path,f'crop_coords.csv'), 'w', newline='\n') as final_file:
+        for i in range(10):
+            with open(os.path.join(save_path,f'crop_coords_{i}.csv'), 'r', newline='\n') as file:
+                shutil.copyfileobj(file, final_file)
 
 
 def brats_preprocess():
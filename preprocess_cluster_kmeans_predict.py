@@ -8,6 +8,7 @@ import math
 import numpy as np
 import random
 import seaborn as sns
+from matplotlib import pyplot as plt
 from tqdm import tqdm
 
 import torch
@@ -15,15 +16,32 @@ import torch.nn as nn
 import torch.nn.functional as f
 from torch import autocast
 
-from faiss import Kmeans
-import faiss.contrib.torch_utils
+import faiss
+import faiss.contrib.torch_utils  # Lets faiss functions (e.g. knn_gpu) take torch tensors
 
 from data import DataGenerator
-from tools import set_seed
+from tools import set_seed, CudaPrefetcher
 
 
 warnings.filterwarnings('ignore')
 
+
+def upsample(featup, x, args):
+    # Get upsampled features from teacher DINO ViT16 encoder for a batch of 2D slices in one forward pass (optionally in mini-batches to fit in memory)
+    # B*D x 1 x H x W -(RGB)->  B*D x 3 x H x W -(DINO)-> B*D x C' x H' x W' -(Upsampler)-> B*D x C' x H x W
+    H, W = x.shape[-2:]
+    feats = []
+    with autocast(device_type='cuda', dtype=torch.float16, enabled=args.amp and not args.cpu):  # FP16 tensor cores for the ViT and upsampler (halves the feature memory)
+        for x_mb in (torch.split(x, args.mb) if args.mb else [x]):
+            x_mb = x_mb.expand(-1,3,-1,-1)  # Grayscale to RGB as a strided view (no copy of the identical channels)
+            if args.upsampler == 'featup':
+                net = featup.module if args.cpu else featup  # On GPU, call the DataParallel wrapper so that the batch is split across GPUs (it refuses CPU parameters)
+                feats.append(net(x_mb))  # Put it through DINO and FeatUP
+            elif args.upsampler == 'interp':
+                feats.append(f.interpolate(featup.module.model(x_mb), size=(H,W), mode='bilinear'))  # Put it only through DINO and upsample with interpolation
+    return torch.cat(feats) if len(feats) > 1 else feats[0]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Self Training benchmark')
     parser.add_argument('--data', metavar='DIR', default='/home/igogou/data/LUNA16',
@@ -33,12 +51,16 @@ if __name__ == '__main__':
     parser.add_argument('--model', default='cluster', choices=['cluster'], help='Choose the model')
     parser.add_argument('--upsampler', default='featup', choices=['featup','interp'], help='Choose the model')
     parser.add_argument('--b', default=16, type=int, help='Batch size')
+    parser.add_argument('--mb', default=None, type=int, help='Mini-batch size of 2D slices for the upsampler (to fit in memory). By default all slices of the batch are processed at once')
     parser.add_argument('--n', default='luna', choices=['luna', 'lidc', 'brats', 'lits'], type=str, help='Dataset to use')
     parser.add_argument('--workers', default=4, type=int, help='Num of workers')
     parser.add_argument('--gpus', default='0,1,2,3', type=str, help='GPU indices to use')
     parser.add_argument('--seed', default=1, type=int)
     parser.add_argument('--k', default=10, type=int, help='Number of clusters for clustering pretask')
     parser.add_argument('--cpu', action='store_true', default=False, help='To run on CPU or not')
+    parser.add_argument('--amp', action='store_true', default=False, help='Run the upsampler and the cluster assignment in FP16 (GPU only)')
+    parser.add_argument('--viz_every', default=0, type=int, help='Save a visualization of the cluster masks every N batches (0 to disable)')
+    parser.add_argument('--compile', action='store_true', default=False, help='Compile the upsampler with torch.compile (only with a single visible GPU, otherwise it is skipped)')
     args = parser.parse_args()
     print(args)
     print()
@@ -55,13 +77,15 @@ if __name__ == '__main__':
 
     # Generate colors for cluster masks
     palette = sns.color_palette(palette='bright', n_colors=args.k)
-    colors = torch.Tensor([list(color) for color in palette]).cpu()
+    colors = torch.tensor(palette, device='cpu' if args.cpu else 'cuda')  # K x 3 lookup table, created once on the same device as the cluster masks
 
     # Get dataloader
     generator = DataGenerator(args)
     loader_name = 'cluster_' + args.n + '_pretask'
     train_loader = getattr(generator, loader_name)(load_gt=False)['train']
     train_loader.shuffle = False
+    if not args.cpu:
+        train_loader = CudaPrefetcher(train_loader)  # Copy the next batch to the GPU while the current one goes through the upsampler
     
     # Get models
     featup = nn.DataParallel(torch.hub.load("mhamilton723/FeatUp", 'dino16', use_norm=False))
@@ -69,10 +93,24 @@ if __name__ == '__main__':
         featup = featup.cuda()
     else:
         featup = featup.cpu()
-    kmeans = Kmeans(d=384, k=args.k, niter=1, seed=args.seed, verbose=False, gpu=True if not args.cpu else False)
     centroids = np.load(os.path.join(args.data,f'kmeans_centroids_k{args.k}_{args.upsampler}.npy')) # TODO: add also argument support 
     # centroids = np.load(os.path.join(args.data,f'kmeans_centroids_k{args.k}.npy')) # TODO: add also argument support (Use only the line bove, this line is for debugging old files)
+    if args.cpu:
+        cpu_index = faiss.IndexFlatL2(centroids.shape[1])  # Exact nearest-centroid index, built once from the pretrained centroids
+        cpu_index.add(centroids)
+    else:
+        res = faiss.StandardGpuResources()
+        centroids_gpu = torch.from_numpy(centroids).cuda()  # Keep centroids on GPU so that the assignment runs directly on the GPU feature tensors
+        if args.amp:
+            centroids_gpu = centroids_gpu.half()  # knn_gpu also takes FP16 vectors, so the features never need to go back to FP32
+        D_buf, I_buf = None, None  # Output buffers of knn_gpu, allocated once for the largest batch and reused
     featup.eval()
+    if args.compile and not args.cpu and torch.cuda.device_count() > 1:
+        # DataParallel replicas copy the module __dict__, so all of them would call the compiled forward of the GPU 0 module (device mismatch)
+        print('WARNING: --compile is skipped because more than one GPU is visible (use --gpus with a single GPU to compile the upsampler)\n')
+    elif args.compile:
+        # Fuse the many small pointwise ops of the ViT (and FeatUp) into fewer kernels
+        (featup.module if args.upsampler == 'featup' else featup.module.model).compile()
 
     # Predict with K-Means --------------------------------------------------------------------------------------------------------------
     print('Predict clusters with K-Means...\n')
@@ -82,57 +120,33 @@ if __name__ == '__main__':
 
             print(f'Iteration {idx}/{len(train_loader)}', flush=True)
 
-            input1 = input1.float()
-            input2 = input2.float()
-
-            if not args.cpu:
-                input1 = input1.cuda()
-                input2 = input2.cuda()
+            # (Inputs are already float and, if not on CPU, already on GPU because of the prefetcher)
 
-            # Convert 3D input to 2D
+            # Stack both crops so that they go through the upsampler and the assignment together and convert 3D input to 2D
             B, C, H, W, D = input1.shape
-            x1 = input1.permute(0,4,1,2,3).reshape(B*D,C,H,W)  # B x C x H x W x D -> B*D x C x H x W
-            x2 = input2.permute(0,4,1,2,3).reshape(B*D,C,H,W)
+            x = torch.cat((input1,input2)).permute(0,4,1,2,3).reshape(2*B*D,C,H,W)  # 2*B x C x H x W x D -> 2*B*D x C x H x W
 
-            with torch.no_grad():
+            with torch.inference_mode():
                 
                 print('     Upsample', flush=True)
                 
-                # Get upsampled features from teacher DINO ViT16 encoder and flatten spatial dimensions to get feature vectors for each pixel
-                # B*D x 1 x H x W -(RGB)->  B*D x 3 x H x W -(DINO)-> B*D x C' x H' x W' -(Upsampler)-> B*D x C' x H x W -(Vectorize)-> B*D*H*W x C' 
-                
-                # feat_vec1 = torch.zeros((B*D,384,H,W))  # C' = 384
-                # feat_vec2 = torch.zeros((B*D,384,H,W))
-                # MB = 4 # Mini-batch size (to work on my local machine)
-                if args.upsampler == 'featup':
-                    # for b_idx in tqdm(range(0,B*D,MB), leave=False):  
-                    #     feat_vec1[b_idx:b_idx+MB] = featup.module(x1[b_idx:b_idx+MB].repeat(1,3,1,1))
-                    #     feat_vec2[b_idx:b_idx+MB] = featup.module(x2[b_idx:b_idx+MB].repeat(1,3,1,1))
-                    feat_vec1 = featup.module(x1.repeat(1,3,1,1))  # Put it through DINO and FeatUP
-                    feat_vec2 = featup.module(x2.repeat(1,3,1,1))
-                elif args.upsampler == 'interp':
-                    # for b_idx in tqdm(range(0,B*D,MB), leave=False):  
-                    #     feat_vec1[b_idx:b_idx+MB] = f.interpolate(featup.module.model(x1[b_idx:b_idx+MB].repeat(1,3,1,1)), size=(H,W), mode='bilinear')
-                    #     feat_vec2[b_idx:b_idx+MB] = f.interpolate(featup.module.model(x2[b_idx:b_idx+MB].repeat(1,3,1,1)),  size=(H,W), mode='bilinear')
-                    feat_vec1 = f.interpolate(featup.module.model(x1.repeat(1,3,1,1)), size=(H,W), mode='bilinear')  # Put it only through DINO and upsample with interpolation
-                    feat_vec2 = f.interpolate(featup.module.model(x2.repeat(1,3,1,1)), size=(H,W), mode='bilinear')
-                feat_vec1 = feat_vec1.permute(0,2,3,1).flatten(0,2)
-                feat_vec2 = feat_vec2.permute(0,2,3,1).flatten(0,2)
-
-                # Prepare data
-                K = args.k
-                N, E = feat_vec1.shape  # Number of points, Feature vector size
+                # Get upsampled features and flatten spatial dimensions to get feature vectors for each pixel
+                # 2*B*D x C' x H x W -(Vectorize)-> 2*B*D*H*W x C' 
+                feat_vec = upsample(featup, x, args)
+                feat_vec = feat_vec.permute(0,2,3,1).flatten(0,2)  # A single copy (of FP16 features with --amp, so half the memory traffic)
 
                 print(      'K-Means', flush=True)
-                kmeans.train(feat_vec1.cpu().numpy(), init_centroids=centroids)  # Dummy train for loading pretrained centroids
-                _, gt_vec1 = kmeans.index.search(feat_vec1.cpu().numpy(), 1)
-                _, gt_vec2 = kmeans.index.search(feat_vec2.cpu().numpy(), 1)
-
-                gt_vec1 = torch.from_numpy(gt_vec1).to(torch.int64)
-                gt_vec2 = torch.from_numpy(gt_vec2).to(torch.int64)
-                if not args.cpu:
-                    gt_vec1 = gt_vec1.cuda()
-                    gt_vec2 = gt_vec2.cuda()
+                if args.cpu:
+                    _, gt_vec = cpu_index.search(feat_vec.numpy(), 1)  # Only the nearest centroid is needed (hard cluster assignment)
+                    gt_vec = torch.from_numpy(gt_vec).to(torch.int64)
+                else:
+                    feat_vec = feat_vec.to(centroids_gpu.dtype)  # No-op unless some upsampler op left the output in another precision
+                    N = feat_vec.shape[0]
+                    if I_buf is None or I_buf.shape[0] < N:
+                        D_buf = torch.empty((N, 1), dtype=torch.float32, device='cuda')
+                        I_buf = torch.empty((N, 1), dtype=torch.int64, device='cuda')
+                    _, gt_vec = faiss.knn_gpu(res, feat_vec, centroids_gpu, 1, D=D_buf[:N], I=I_buf[:N])  # Nearest centroid of each feature vector (written into the int64 GPU buffer)
+                gt_vec1, gt_vec2 = gt_vec.chunk(2)  # Split back into the two crops
 
                 # Restore spatial dimensions
                 gt1 = gt_vec1.reshape(B, D, H, W).permute(0,2,3,1)  # B*D*H*W -> B x D x H x W -> B x H x W x D
@@ -149,44 +163,42 @@ if __name__ == '__main__':
                 tqdm_progress.update(1)
 
 
-                # # Stuff for Debugging:
-
-                # # Select 2D images
-                # img_idx = 0
-                # m_idx = 0
-                # s_idx = D//2
-                # in1 = input1[img_idx,m_idx,:,:,s_idx].unsqueeze(0)
-                # in2 = input2[img_idx,m_idx,:,:,s_idx].unsqueeze(0)
-                # gt1_img = gt1[img_idx,:,:,s_idx].unsqueeze(0)
-                # gt2_img = gt2[img_idx,:,:,s_idx].unsqueeze(0)
-
-                # # Min-max norm input images
-                # in1 = (in1 - in1.min())/(in1.max() - in1.min())
-                # in2 = (in2 - in2.min())/(in2.max() - in2.min())
-
-                # # Send to cpu
-                # in1 = in1.cpu().detach()
-                # in2 = in2.cpu().detach()
-                # gt1_img = gt1_img.cpu().detach()
-                # gt2_img = gt2_img.cpu().detach()
-
-                # # Give color to each cluster in cluster masks
-                # gt1_img = gt1_img.repeat((3,1,1)).permute(1,2,0).float()
-                # gt2_img = gt2_img.repeat((3,1,1)).permute(1,2,0).float()
-                # for c in range(colors.shape[0]):
-                #     gt1_img[gt1_img[:,:,0] == c] = colors[c]
-                #     gt2_img[gt2_img[:,:,0] == c] = colors[c]
-                # gt1_img = gt1_img.permute(2,0,1)
-                # gt2_img = gt2_img.permute(2,0,1)
-
-                # # Pad images for better visualization
-                # in1 = f.pad(in1.unsqueeze(0),(2,1,2,2),value=1)
-                # in2 = f.pad(in2.unsqueeze(0),(1,2,2,2),value=1)                
-                # gt1_img = f.pad(gt1_img.unsqueeze(0),(2,1,2,2),value=1)
-                # gt2_img = f.pad(gt2_img.unsqueeze(0),(1,2,2,2),value=1)
-
-                # # Combine crops
-                # in_img = torch.cat((in1,in2),dim=3).squeeze(0).cpu().detach().numpy()
-                # gt_img = torch.cat((gt1_img,gt2_img),dim=3).squeeze(0).cpu().detach().numpy()
-
-                # test=123
+                # Visualize a slice of the first sample every few batches (only for debugging, since it syncs with the GPU)
+                if args.viz_every and idx % args.viz_every == 0:
+
+                    # Select 2D images
+                    img_idx = 0
+                    m_idx = 0
+                    s_idx = D//2
+                    in1 = input1[img_idx,m_idx,:,:,s_idx].unsqueeze(0)
+                    in2 = input2[img_idx,m_idx,:,:,s_idx].unsqueeze(0)
+                    gt1_img = gt1[img_idx,:,:,s_idx].unsqueeze(0)
+                    gt2_img = gt2[img_idx,:,:,s_idx].unsqueeze(0)
+
+                    # Min-max norm input images
+                    in1 = (in1 - in1.min())/(in1.max() - in1.min())
+                    in2 = (in2 - in2.min())/(in2.max() - in2.min())
+
+                    # Give color to each cluster in cluster masks (index the palette with the cluster ids, on the same device)
+                    gt1_img = colors[gt1_img[0]].permute(2,0,1)  # 1 x H x W -> H x W x 3 -> 3 x H x W
+                    gt2_img = colors[gt2_img[0]].permute(2,0,1)
+
+                    # Send to cpu
+                    in1 = in1.cpu().detach()
+                    in2 = in2.cpu().detach()
+                    gt1_img = gt1_img.cpu().detach()
+                    gt2_img = gt2_img.cpu().detach()
+
+                    # Pad images for better visualization
+                    in1 = f.pad(in1.unsqueeze(0),(2,1,2,2),value=1)
+                    in2 = f.pad(in2.unsqueeze(0),(1,2,2,2),value=1)
+                    gt1_img = f.pad(gt1_img.unsqueeze(0),(2,1,2,2),value=1)
+                    gt2_img = f.pad(gt2_img.unsqueeze(0),(1,2,2,2),value=1)
+
+                    # Combine crops
+                    in_img = torch.cat((in1,in2),dim=3).squeeze(0).cpu().detach().numpy()
+                    gt_img = torch.cat((gt1_img,gt2_img),dim=3).squeeze(0).cpu().detach().numpy()
+
+                    # Save input crops on top of their cluster masks
+                    viz_img = np.concatenate((np.repeat(in_img, 3, axis=0), gt_img), axis=1).transpose(1,2,0)  # 3 x 2H x 2W -> 2H x 2W x 3
+                    plt.imsave(os.path.join(args.data, f'viz_k{args.k}_{args.upsampler}_{idx}.png'), viz_img.clip(0,1))
@@ -1,50 +1,125 @@
 from glob import glob
+import argparse
+import functools
+import json
 import numpy as np
 import re
 import math
 import os
-import re
+import zipfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.distributed as dist
+from torch.utils.data.dataloader import default_collate
 from torch.utils.tensorboard import SummaryWriter
 import random
 from PIL import ImageFilter
 import torch.nn.functional as F
+from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
 from torchvision import ops
 import segmentation_models_pytorch as smp
 from models import PCRLv23d, PCRLv2, SegmentationModel, UNet3D
 
+_rng = np.random.default_rng()  # Random generator of the augmentations (seeded in set_seed and in each dataloader worker by seed_worker)
+_K_RE = re.compile(r'_k[0-9]+_')  # Number of clusters in the name of cluster pretrain weight files
+
+# Layers to finetune for each finetune option (up_tr and out_tr for cluster/pcrlv2/genesis/scratch, decoder and seg_head for imagenet)
+_FINETUNE_RE = {'all': None,
+                'last': re.compile(r'out_tr|segmentation_head'),
+                'decoder': re.compile(r'up_tr|out_tr|decoder|segmentation_head')}
+
 
-def set_seed(seed):
+def set_seed(seed, deterministic=False):
+    global _rng
     os.environ['PYTHONHASHSEED'] = str(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    if deterministic:  # Reproducible but slower cuDNN algorithms and full FP32 matmuls and convolutions (no TF32)
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cuda.matmul.allow_tf32 = False
+        torch.backends.cudnn.allow_tf32 = False
+        torch.set_float32_matmul_precision('highest')
+    else:  # Let cuDNN pick the fastest algorithms and use TF32 tensor cores (Ampere+) for matmuls and convolutions
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
     np.random.seed(seed)
     random.seed(seed)
+    _rng = np.random.default_rng(seed)
 
 
 def seed_worker(worker_id):  # This is for the workers of the dataloader that need different seeds
+    global _rng
     worker_seed = torch.initial_seed() % 2**32
     np.random.seed(worker_seed)
     random.seed(worker_seed)
+    _rng = np.random.default_rng(worker_seed)
+
+
+def worker_kwargs(workers):
+    # Keep the dataloader workers alive between epochs and let each one prefetch more batches (only possible with worker processes)
+    return {'persistent_workers': True, 'prefetch_factor': 4} if workers > 0 else {}
+
+
+def local_views_collate(batch):
+    # Default collate, except that the local views (item 6 of each pretask sample) are stacked in the worker into one V * B x C x d x h x w tensor,
+    # in the order of torch.cat over the views (view major), so the loader pins it once and the training loop does not concatenate them
+    local_views = [sample[6] for sample in batch]
+    batch = list(default_collate([tuple(sample[:6]) + ([],) + tuple(sample[7:]) for sample in batch]))
+    if len(local_views[0]) > 0:
+        batch[6] = torch.stack([torch.as_tensor(views[v]) for v in range(len(local_views[0])) for views in local_views])
+    return batch
+
+
+def input_memory_format(args):
+    # Memory format of the 3D pretask inputs, the same as the model (channels-last with --channels_last on GPU)
+    return torch.channels_last_3d if args.channels_last and not args.cpu else torch.contiguous_format
+
+
+def init_distributed(args):
+    # Join the process group when launched with torchrun (one process per GPU). Returns the local rank, or None if not distributed
+    if args.cpu or 'LOCAL_RANK' not in os.environ:
+        return None
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if not dist.is_initialized():
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend='nccl')
+    return local_rank
+
+
+def is_main_process():  # Only the main process (rank 0) logs, prints and saves
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def any_process(flag):
+    # True if the flag is True in any process, so that all processes take the same branch (e.g. skipping a step) and their all-reduces match
+    if not dist.is_initialized():
+        return bool(flag)
+    # A flag tensor (e.g. loss > 1000) is reduced on the device, so the only sync is reading the result
+    flag = flag.int() if torch.is_tensor(flag) else torch.tensor(int(bool(flag)), device=torch.cuda.current_device())
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
 
 
 def create_logger(args):
     curr_time = str(time.time()).replace(".", "")
+    lr_str = f'{args.lr:f}'.split('.')[-1]  # Decimal digits of the learning rate
     
     if args.phase in ['finetune', 'pretask']:  # If finetune or pretask, use the specified output path
         folder_name = None
         
         if args.phase == 'finetune':
             if 'cluster' in args.model:
-                cluster_k = re.search(r'_k[0-9]+_', args.weight).group(0)[1:]
+                cluster_k = _K_RE.search(args.weight).group(0)[1:]
             else:
                 cluster_k = ''
             sc = 'sc_' if args.skip_conn else ''
-            run_name = f'{args.model}_{args.d}d_{cluster_k}{sc}pretrain_{args.pretrained}_finetune_{args.finetune}_b{args.b}_e{args.epochs}_lr{"{:f}".format(args.lr).split(".")[-1]}_r{int(args.ratio * 100)}_t{curr_time}'
+            run_name = f'{args.model}_{args.d}d_{cluster_k}{sc}pretrain_{args.pretrained}_finetune_{args.finetune}_b{args.b}_e{args.epochs}_lr{lr_str}_r{int(args.ratio * 100)}_t{curr_time}'
             
             pretrain_type = None
             # Pretrain types that use weights
@@ -70,9 +145,9 @@ def create_logger(args):
         elif args.phase == 'pretask':
             sc = "sc_" if args.skip_conn else ""
             if args.model == 'pcrlv2':
-                run_name = f'{args.model}_{args.d}d_{sc}pretask_b{args.b}_e{args.epochs}_lr{"{:f}".format(args.lr).split(".")[-1]}_t{curr_time}'
+                run_name = f'{args.model}_{args.d}d_{sc}pretask_b{args.b}_e{args.epochs}_lr{lr_str}_t{curr_time}'
             elif 'cluster' in args.model:
-                run_name = f'{args.model}_{args.d}d_k{args.k}_{args.cluster_loss}_{sc}pretask_b{args.b}_e{args.epochs}_lr{"{:f}".format(args.lr).split(".")[-1]}_t{curr_time}'
+                run_name = f'{args.model}_{args.d}d_k{args.k}_{args.cluster_loss}_{sc}pretask_b{args.b}_e{args.epochs}_lr{lr_str}_t{curr_time}'
             folder_name = args.model + '_' + args.n + '_pretrain'
         
         if not os.path.exists(os.path.join(args.output,folder_name)):
@@ -83,14 +158,84 @@ def create_logger(args):
         run_dir = args.weight.replace('.pt','') # remove .pt
 
     writer = None   
-    if args.tensorboard or args.vis:  # Create tensorboard writer
+    if (args.tensorboard or args.vis) and is_main_process():  # Create tensorboard writer
         assert args.tensorboard  # args.vis can only be used with args.tensorboard
         print(f'Tensorboard logging at: {run_dir}\n')
-        writer = SummaryWriter(run_dir)
+        writer = BufferedSummaryWriter(SummaryWriter(run_dir, flush_secs=120, max_queue=1000))  # Larger event queue and fewer disk flushes
 
     return writer, run_dir
 
 
+class BufferedSummaryWriter(object):
+    """Wraps a SummaryWriter, buffering scalars (written every flush_every scalars) and rendering/logging visualizations in a background thread"""
+
+    def __init__(self, writer, flush_every=50):
+        self.writer = writer
+        self.flush_every = flush_every
+        self.scalars = []
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Background thread for visualizations (rendered and logged in submission order)
+        self.futures = []
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None):
+        if torch.is_tensor(scalar_value):
+            scalar_value = scalar_value.detach()  # Only converted to a number (GPU sync) when written
+        self.scalars.append((tag, scalar_value, global_step, time.time() if walltime is None else walltime))
+        if len(self.scalars) >= self.flush_every:
+            self.write_scalars()
+
+    def write_scalars(self):
+        for tag, scalar_value, global_step, walltime in self.scalars:
+            self.writer.add_scalar(tag, scalar_value, global_step, walltime)
+        self.scalars = []
+
+    def background(self, fn, *args):
+        # Run fn(*args) (e.g. plotting and logging a figure) in the background thread instead of the training loop
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()  # Raise the errors of finished tasks
+            else:
+                pending.append(future)
+        self.futures = pending + [self.executor.submit(fn, *args)]
+
+    def add_images_async(self, images, global_step):
+        # Log {tag: CHW image} without waiting for the GPU: start the copies to the CPU, and let the background thread wait for them
+        images = {tag: img.detach().to('cpu', non_blocking=True) if img.is_cuda else img.detach() for tag, img in images.items()}
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self.background(self._write_images, images, global_step, copied)
+
+    def _write_images(self, images, global_step, copied):
+        if copied is not None:
+            copied.synchronize()
+        for tag, img in images.items():
+            self.writer.add_image(tag, img_tensor=img.numpy(), global_step=global_step, dataformats='CHW')
+
+    def wait(self):
+        # Block until all background visualizations are logged
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def flush(self):
+        self.wait()
+        self.write_scalars()
+        self.writer.flush()
+
+    def close(self):
+        self.executor.shutdown(wait=True)  # Let every queued figure and image be rendered and logged before closing the writer
+        try:
+            self.wait()  # Raise the errors of the background tasks, if any
+        finally:
+            self.write_scalars()
+            self.writer.close()
+
+    def __getattr__(self, name):  # Everything else (add_image, add_graph, log_dir, ...) goes directly to the writer
+        return getattr(self.writer, name)
+
+
 def get_model(args, in_channels, n_class):
     if args.model == 'scratch':
         if args.phase == 'finetune':
@@ -128,14 +273,33 @@ def get_model(args, in_channels, n_class):
         if args.phase == 'finetune':
             assert args.pretrained == 'encoder'
             assert args.weight == None
-        model = PCRLv2(in_channels=in_channels, n_class=n_class, encoder_weights='imagenet', segmentation=True)
+        encoder_weights = None if args.phase == 'test' else 'imagenet'  # When testing, the finetuned weights replace all weights (no download)
+        model = PCRLv2(in_channels=in_channels, n_class=n_class, encoder_weights=encoder_weights, segmentation=True)
     return model
 
 
+def load_checkpoint_state(weight_path):
+    # Memory-map the checkpoint instead of reading it all in RAM, and unpickle only tensors and basic types (weights_only)
+    # Tensors stay on CPU (the model is moved to the GPU once, after the weights are assigned)
+    map_location = torch.device('cpu')
+    if not hasattr(torch.serialization, 'safe_globals'):  # Older PyTorch cannot allow the stored run arguments in a weights_only load
+        print(f'WARNING: Loading {weight_path} with full unpickling because of the old PyTorch version (only load trusted files)')
+        return torch.load(weight_path, map_location=map_location)['state_dict']
+    mmap = zipfile.is_zipfile(weight_path)
+    if not mmap:
+        print(f'WARNING: {weight_path} is a legacy (non-zip) checkpoint, so it is not memory-mapped')
+    with torch.serialization.safe_globals([argparse.Namespace]):  # Pretrain checkpoints also store the run arguments ('opt')
+        return torch.load(weight_path, map_location=map_location, mmap=mmap, weights_only=True)['state_dict']
+
+
 def prepare_model(args, in_channels, n_class):
 
     # Get model
-    model = get_model(args, in_channels, n_class)
+    if args.phase == 'test':  # All weights come from the weight file, so build the model without allocating (or initializing) its parameters
+        with torch.device('meta'):
+            model = get_model(args, in_channels, n_class)
+    else:  # When finetuning, layers that are not pretrained need their default initialization
+        model = get_model(args, in_channels, n_class)
           
     # Prepare for finetuning
     if args.phase == 'finetune':
@@ -147,29 +311,25 @@ def prepare_model(args, in_channels, n_class):
 
             model_dict = model.state_dict()
             weight_path = args.weight
-            if args.cpu:
-                state_dict = torch.load(weight_path, map_location=torch.device('cpu'))['state_dict']
-            else:
-                state_dict = torch.load(weight_path)['state_dict']
+            state_dict = load_checkpoint_state(weight_path)
             
-            # If model is genesis, unparallelize weights
+            # If model is genesis, unparallelize weights (strip the DataParallel prefix in place)
             if args.model == 'genesis':
-                tmp_state_dict = {}
-                for key in state_dict.keys():
-                    tmp_state_dict[key.replace("module.", "")] = state_dict[key]
-                state_dict = tmp_state_dict
+                consume_prefix_in_state_dict_if_present(state_dict, "module.")
 
             if args.pretrained == 'encoder' or args.pretrained == 'all':
                 # Load pretrained encoder
                 if args.d == 3:
                     first_conv_weight = state_dict['down_tr64.ops.0.conv1.weight']
-                    first_conv_weight = first_conv_weight.repeat((1, in_channels, 1, 1, 1))
+                    if first_conv_weight.shape[1] != in_channels:  # Only copy the weight if the input channels differ
+                        first_conv_weight = first_conv_weight.repeat((1, in_channels, 1, 1, 1))
                     state_dict['down_tr64.ops.0.conv1.weight'] = first_conv_weight
                     pretrain_dict.update({k: v for k, v in state_dict.items() if
                                 k in model_dict and 'down_tr' in k})
                 elif args.d == 2:
                     first_conv_weight = state_dict['encoder.conv1.weight']
-                    first_conv_weight = first_conv_weight.repeat((1, in_channels, 1, 1))
+                    if first_conv_weight.shape[1] != in_channels:
+                        first_conv_weight = first_conv_weight.repeat((1, in_channels, 1, 1))
                     state_dict['encoder.conv1.weight'] = first_conv_weight
                     pretrain_dict.update({k: v for k, v in state_dict.items() if
                                 k in model_dict and 'encoder' in k})
@@ -178,10 +338,11 @@ def prepare_model(args, in_channels, n_class):
                 # Load pretrained decoder
                 if args.d == 3:
                     last_conv_weight = state_dict['out_tr.final_conv.weight']
-                    last_conv_weight = last_conv_weight.repeat((n_class, 1, 1, 1, 1))
-                    state_dict['out_tr.final_conv.weight'] = last_conv_weight
                     last_conv_bias = state_dict['out_tr.final_conv.bias']
-                    last_conv_bias = last_conv_bias.repeat((n_class))
+                    if last_conv_weight.shape[0] != n_class:  # Only copy the weight and bias if the output classes differ
+                        last_conv_weight = last_conv_weight.repeat((n_class, 1, 1, 1, 1))
+                        last_conv_bias = last_conv_bias.repeat((n_class))
+                    state_dict['out_tr.final_conv.weight'] = last_conv_weight
                     state_dict['out_tr.final_conv.bias'] = last_conv_bias
                     # If skip connections are added, then do not load up_tr*.ops.0.*
                     if args.skip_conn:  
@@ -208,55 +369,36 @@ def prepare_model(args, in_channels, n_class):
                     #                     k in model_dict and ('up_tr' in k or 'out_tr' in k)})
 
             model_dict.update(pretrain_dict)
-            model.load_state_dict(model_dict)
+            model.load_state_dict(model_dict, assign=True)  # Use the loaded tensors as parameters instead of copying them into the initialized ones
 
-        # Set finetune weights
+        # Set finetune weights (in one pass: a parameter is trainable if all layers are finetuned or if its name matches the finetuned layers)
+        finetune_re = _FINETUNE_RE[args.finetune]
+        finetune_names = []
+        frozen_names = []
         for name, param in model.named_parameters():
-            param.requires_grad = True  # Make all parameters trainable
-
-        if args.finetune == 'last':  # Freeze everything but last layer
-            for name, param in model.named_parameters():
-                if all(layer not in name for layer in ['out_tr', 'segmentation_head']):
-                    param.requires_grad = False
-
-        elif args.finetune == 'decoder':  # Freeze encoder
-            for name, param in model.named_parameters():
-                if all(layer not in name for layer in ['up_tr', 'out_tr', 'decoder', 'segmentation_head']):  # up_tr and out_tr for cluster/pcrlv2/genesis/scratch, decoder and seg_head for imagenet
-                    param.requires_grad = False
-
-        # Print parameters
-        model_dict = model.state_dict()
-        print(f'Pretrained parameters from weight file (including buffers): {len(pretrain_dict.keys())}/{len(model_dict.keys())}')
-        if pretrain_dict:
-            print(pretrain_dict.keys())
-        else:
-            print(None)
+            param.requires_grad = finetune_re is None or finetune_re.search(name) is not None
+            (finetune_names if param.requires_grad else frozen_names).append(name)
+        n_params = len(finetune_names) + len(frozen_names)
+
+        # Print parameters (the names only with --verbose)
+        print(f'Pretrained parameters from weight file (including buffers): {len(pretrain_dict)}/{len(model.state_dict())}')
+        if args.verbose:
+            print(list(pretrain_dict.keys()) or None)
         print()
-        finetune_dict = {k: v for k, v in model.named_parameters() if
-                                v.requires_grad == True}                         
-        print(f'Finetuning parameters: {len(finetune_dict.keys())}/{len(list(model.named_parameters()))}')
-        if len(finetune_dict)!=0:
-            print(finetune_dict.keys())
-        else:
-            print(None)
+        print(f'Finetuning parameters: {len(finetune_names)}/{n_params}')
+        if args.verbose:
+            print(finetune_names or None)
         print()
-        frozen_dict = {k: v for k, v in model.named_parameters() if
-                                v.requires_grad == False}
-        print('Frozen parameters:')
-        if len(frozen_dict)!=0:
-            print(frozen_dict.keys())
-        else:
-            print(None)
+        print(f'Frozen parameters: {len(frozen_names)}/{n_params}')
+        if args.verbose:
+            print(frozen_names or None)
         print()
 
     # Prepare for testing
     elif args.phase == 'test':
         weight_path = args.weight    
-        if args.cpu:
-            state_dict = torch.load(weight_path, map_location=torch.device('cpu'))['state_dict']
-        else:
-            state_dict = torch.load(weight_path)['state_dict']
-        model.load_state_dict(state_dict)
+        state_dict = load_checkpoint_state(weight_path)
+        model.load_state_dict(state_dict, assign=True)  # Materialize the meta parameters directly from the loaded tensors
 
     return model
 
@@ -276,60 +418,49 @@ def get_chest_list(txt_path, data_dir):
     return image_names, labels
 
 
+@functools.lru_cache(maxsize=None)
+def _load_split(dataset):
+    # Patient/scan lists of a dataset split manifest ({'train': [...], 'valid': [...], 'test': [...]}), parsed once per run
+    with open(os.path.join('train_val_txt', dataset + '.json'), 'r') as f:
+        return json.load(f)
+
+
 def get_luna_pretrain_list(ratio):
-    x_train = []
-    with open('train_val_txt/luna_train.txt', 'r') as f:
-        for line in f:
-            x_train.append(line.strip('\n'))
+    x_train = list(_load_split('luna')['train'])
     return x_train[:int(len(x_train) * ratio)]
 
 
 def get_luna_finetune_list(ratio, path, train_fold):
-    x_train = []
-    with open('train_val_txt/luna_train.txt', 'r') as f:
-        for line in f:
-            x_train.append(line.strip('\n'))
+    x_train = list(_load_split('luna')['train'])
     return x_train[:int(len(x_train) * ratio)]
 
 
+@functools.lru_cache(maxsize=None)
+def _scan_suffix(dirpath, suffix):
+    # Paths of the files in a folder that contain the suffix (excluding ground truth files), cached because folds are listed more than once
+    with os.scandir(dirpath) as entries:
+        return tuple(entry.path for entry in entries if suffix in entry.name and 'gt' not in entry.name)
+
+
+def _scan_folders(dirpaths, suffix):
+    # Scan the folders in parallel threads (listing a folder is I/O bound and releases the GIL), keeping the folder order
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return [path for paths in executor.map(lambda dirpath: _scan_suffix(dirpath, suffix), dirpaths) for path in paths]
+
+
 def get_luna_list(config, train_fold, valid_fold, test_fold, suffix, file_list):
-    x_train = []
-    x_valid = []
-    x_test = []
-    for i in train_fold:
-        for file in os.listdir(os.path.join(config.data, 'subset' + str(i))):
-            if suffix in file and 'gt' not in file:
-                if file_list is not None and file.split('_')[0] in file_list:
-                    x_train.append(os.path.join(config.data, 'subset' + str(i), file))
-                elif file_list is None:
-                    x_train.append(os.path.join(config.data, 'subset' + str(i), file))
-    for i in valid_fold:
-        for file in os.listdir(os.path.join(config.data, 'subset' + str(i))):
-            if suffix in file and 'gt' not in file:
-                x_valid.append(os.path.join(config.data, 'subset' + str(i), file))
-    for i in test_fold:
-        for file in os.listdir(os.path.join(config.data, 'subset' + str(i))):
-            if suffix in file and 'gt' not in file:
-                x_test.append(os.path.join(config.data, 'subset' + str(i), file))
+    file_set = frozenset(file_list) if file_list is not None else None
+    x_train = [path for path in _scan_folders([os.path.join(config.data, 'subset' + str(i)) for i in train_fold], suffix)
+               if file_set is None or os.path.basename(path).split('_')[0] in file_set]
+    x_valid = _scan_folders([os.path.join(config.data, 'subset' + str(i)) for i in valid_fold], suffix)
+    x_test = _scan_folders([os.path.join(config.data, 'subset' + str(i)) for i in test_fold], suffix)
     return x_train, x_valid, x_test
 
 def get_lidc_list(ratio):
-    val_patients_list = []
-    train_patients_list = []
-    test_patients_list = []
-    with open('./train_val_txt/lidc_train.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            train_patients_list.append(line)
-    with open('./train_val_txt/lidc_valid.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            val_patients_list.append(line)
-    with open('./train_val_txt/lidc_test.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            test_patients_list.append(line)
-    train_patients_list = train_patients_list[: int(len(train_patients_list) * ratio)]
+    split = _load_split('lidc')
+    train_patients_list = split['train'][: int(len(split['train']) * ratio)]
+    val_patients_list = list(split['valid'])
+    test_patients_list = list(split['test'])
     print(
         f"Train Patients: {len(train_patients_list)}, Valid Patients: {len(val_patients_list)},"
         f"Test Patients {len(test_patients_list)}\n")
@@ -337,21 +468,10 @@ def get_lidc_list(ratio):
 
 
 def get_brats_list(data, ratio):
-    val_patients_list = []
-    train_patients_list = []
-    test_patients_list = []
-    with open('./train_val_txt/brats_train.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            train_patients_list.append(os.path.join(data, line))
-    with open('./train_val_txt/brats_valid.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            val_patients_list.append(os.path.join(data, line))
-    with open('./train_val_txt/brats_test.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            test_patients_list.append(os.path.join(data, line))
+    split = _load_split('brats')
+    train_patients_list = [os.path.join(data, patient) for patient in split['train']]
+    val_patients_list = [os.path.join(data, patient) for patient in split['valid']]
+    test_patients_list = [os.path.join(data, patient) for patient in split['test']]
     train_patients_list = train_patients_list[: int(len(train_patients_list) * ratio)]
     print(
         f"Train Patients: {len(train_patients_list)}, Valid Patients: {len(val_patients_list)},"
@@ -360,30 +480,10 @@ def get_brats_list(data, ratio):
 
 
 def get_brats_pretrain_list(data, ratio, suffix):
-    val_patients_list = []
-    train_patients_list = []
-    test_patients_list = []
-    with open('./train_val_txt/brats_train.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            train_patient_path = os.path.join(data, line)
-            for file in os.listdir(train_patient_path):
-                if suffix in file and 'gt' not in file:  # Do not include ground truth files for clustering
-                    train_patients_list.append(os.path.join(train_patient_path, file))
-    with open('./train_val_txt/brats_valid.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            val_patient_path = os.path.join(data, line)
-            for file in os.listdir(val_patient_path):
-                if suffix in file and 'gt' not in file:
-                    val_patients_list.append(os.path.join(val_patient_path, file))
-    with open('./train_val_txt/brats_test.txt', 'r') as f:
-        for line in f:
-            line = line.strip('\n')
-            test_patient_path = os.path.join(data, line)
-            for file in os.listdir(test_patient_path):
-                if suffix in file and 'gt' not in file:
-                    test_patients_list.append(os.path.join(test_patient_path, file))
+    split = _load_split('brats')
+    train_patients_list = _scan_folders([os.path.join(data, patient) for patient in split['train']], suffix)  # Ground truth files are not included for clustering
+    val_patients_list = _scan_folders([os.path.join(data, patient) for patient in split['valid']], suffix)
+    test_patients_list = _scan_folders([os.path.join(data, patient) for patient in split['test']], suffix)
     train_patients_list = train_patients_list[: int(len(train_patients_list) * ratio)]
     print(
         f"train patients: {len(train_patients_list)}, valid patients: {len(val_patients_list)},"
@@ -392,16 +492,11 @@ def get_brats_pretrain_list(data, ratio, suffix):
 
 
 def get_luna_finetune_nodule(config, train_fold, valid_txt, test_txt, suffix, file_list):
-    x_train = []
+    file_set = frozenset(file_list) if file_list is not None else None
+    x_train = [path for path in _scan_folders([os.path.join(config.data, 'subset' + str(i)) for i in train_fold], suffix)
+               if file_set is None or os.path.basename(path).split('_')[0] in file_set]
     x_valid = []
     x_test = []
-    for i in train_fold:
-        for file in os.listdir(os.path.join(config.data, 'subset' + str(i))):
-            if suffix in file and 'gt' not in file:
-                if file_list is not None and file.split('_')[0] in file_list:
-                    x_train.append(os.path.join(config.data, 'subset' + str(i), file))
-                elif file_list is None:
-                    x_train.append(os.path.join(config.data, 'subset' + str(i), file))
     with open(valid_txt, 'r') as f:
         for line in f:
             x_valid.append(line.strip('\n'))
@@ -445,22 +540,16 @@ class Cutout(object):
         h = img.size(1)
         w = img.size(2)
 
-        mask = np.ones((h, w), np.float32)
+        # Sample all hole centers at once and build the mask on the image device (no loop, no host to device copy)
+        y = torch.randint(h, (self.n_holes, 1, 1), device=img.device)
+        x = torch.randint(w, (self.n_holes, 1, 1), device=img.device)
+        rows = torch.arange(h, device=img.device).view(1, h, 1)
+        cols = torch.arange(w, device=img.device).view(1, 1, w)
+        holes = (rows >= y - self.length // 2) & (rows < y + self.length // 2) & \
+                (cols >= x - self.length // 2) & (cols < x + self.length // 2)  # n_holes x H x W (clipped to the image implicitly)
 
-        for n in range(self.n_holes):
-            y = np.random.randint(h)
-            x = np.random.randint(w)
-
-            y1 = np.clip(y - self.length // 2, 0, h)
-            y2 = np.clip(y + self.length // 2, 0, h)
-            x1 = np.clip(x - self.length // 2, 0, w)
-            x2 = np.clip(x + self.length // 2, 0, w)
-
-            mask[y1: y2, x1: x2] = 0.
-
-        mask = torch.from_numpy(mask)
-        mask = mask.expand_as(img)
-        img = img * mask
+        mask = (~holes.any(0)).to(img.dtype)
+        img = img * mask  # Broadcast over the channels
 
         return img
 
@@ -482,26 +571,71 @@ def adjust_learning_rate(epoch, args, optimizer):
 
 
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value (tensors are accumulated on their device and only synced when read)"""
 
     def __init__(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
         self.reset()
 
     def reset(self):
-        self.val = 0
-        self.avg = 0
+        self._val = 0
         self.sum = 0
         self.count = 0
 
     def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
+        if torch.is_tensor(val):
+            val = val.detach()
+        self._val = val
+        self.sum = self.sum + val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def val(self):
+        return self._val.item() if torch.is_tensor(self._val) else self._val
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return 0
+        avg = self.sum / self.count
+        return avg.item() if torch.is_tensor(avg) else avg
+
+    def all_reduce(self):
+        # Sum over all processes (under DistributedDataParallel), so that avg is the average of the whole epoch and not of one shard
+        if dist.is_initialized():
+            totals = torch.tensor([float(self.sum), self.count], dtype=torch.float64, device=torch.cuda.current_device())
+            dist.all_reduce(totals)
+            self.sum, self.count = totals[0].item(), int(totals[1].item())
+        return self
+
+
+class StepTimer(object):
+    """Times a training step with CUDA events, which are only read (waiting for the GPU) when elapsed() is called"""
+
+    def __init__(self, cuda=True):
+        self.cuda = cuda and torch.cuda.is_available()
+        if self.cuda:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.end_event = torch.cuda.Event(enable_timing=True)
+        self.start_time = self.end_time = time.time()
+
+    def start(self):
+        if self.cuda:
+            self.start_event.record()
+        else:
+            self.start_time = time.time()
+
+    def stop(self):
+        if self.cuda:
+            self.end_event.record()
+        else:
+            self.end_time = time.time()
+
+    def elapsed(self):
+        # Seconds between the last start() and stop()
+        if self.cuda:
+            self.end_event.synchronize()
+            return self.start_event.elapsed_time(self.end_event) / 1000
+        return self.end_time - self.start_time
 
 
 class GaussianBlur(object):
@@ -511,25 +645,113 @@ class GaussianBlur(object):
         self.sigma = sigma
 
     def __call__(self, x):
-        sigma = random.uniform(self.sigma[0], self.sigma[1])
+        sigma = _rng.uniform(self.sigma[0], self.sigma[1])
         x = x.filter(ImageFilter.GaussianBlur(radius=sigma))
         return x
 
 
-def bceDiceLoss(input, target, train=True):
-    bce = F.binary_cross_entropy_with_logits(input, target)
+class CudaPrefetcher(object):
+    """Wraps a dataloader and copies the next batch to the GPU on a side stream while the current batch is processed"""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_cuda(self, batch):
+        # Recursively send tensors (also inside lists/tuples, e.g. local views) to the GPU asynchronously (needs pin_memory=True in the loader)
+        if torch.is_tensor(batch):
+            return batch.cuda(non_blocking=True)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_cuda(b) for b in batch)
+        return batch
+
+    def _record(self, batch):
+        # Mark tensors as used by the compute stream so that their memory is not reused by the side stream too early
+        if torch.is_tensor(batch):
+            batch.record_stream(torch.cuda.current_stream())
+        elif isinstance(batch, (list, tuple)):
+            for b in batch:
+                self._record(b)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_cuda(batch)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            self._record(batch)
+            next_batch = self._preload(loader_iter)  # Start copying the next batch before handing over the current one
+            yield batch
+
+
+class AsyncCheckpointer(object):
+    """Saves checkpoints in a background thread after copying their tensors to pinned CPU memory (freed once the file is written)"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)  # A single writer, so that saves to the same file happen in order
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.future = None
+
+    def _copy(self, obj):
+        # Recursively copy the tensors of a (nested) checkpoint to the CPU
+        if torch.is_tensor(obj):
+            return torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.stream is not None).copy_(obj.detach(), non_blocking=True)
+        if isinstance(obj, dict):
+            return {k: self._copy(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._copy(v) for v in obj)
+        return obj
+
+    def save(self, state, path):
+        self.wait()  # At most one checkpoint is kept in host memory, so the previous one must be on disk first
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.stream):
+                cpu_state = self._copy(state)
+            self.stream.synchronize()  # Only the device to host copy blocks, writing to disk does not
+        else:
+            cpu_state = self._copy(state)
+        self.future = self.executor.submit(torch.save, cpu_state, path)
+
+    def wait(self):
+        # Block until the pending checkpoint is on disk, then release its copy
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+
+def _bce_dice_loss_per_channel(input, target, train=True):
+    # BCE + Dice loss for each channel of B x C x ... tensors with a single reduction per term (returns a C-sized tensor)
     smooth = 1e-5
-    num = target.size(0)
-    input = input.reshape(num, -1)
-    target = target.reshape(num, -1)
-    intersection = (input * target)
-    dice = (2. * intersection.sum(1) + smooth) / (input.sum(1) + target.sum(1) + smooth)
-    dice = 1 - dice.sum() / num  # Notice that the lower the dice loss the better (we minimize the loss)
-    if train:
+    num, ch = target.shape[:2]
+    input = input.reshape(num, ch, -1)
+    target = target.reshape(num, ch, -1)
+    intersection = torch.einsum('bcn,bcn->bc', input, target)  # Sum of input * target without materializing the product
+    dice = (2. * intersection + smooth) / (input.sum(2) + target.sum(2) + smooth)
+    dice = 1 - dice.sum(0) / num  # Notice that the lower the dice loss the better (we minimize the loss)
+    if train:  # BCE is only part of the training loss, so it is not computed otherwise
+        bce = F.binary_cross_entropy_with_logits(input, target, reduction='none').mean((0,2))
         return dice + 0.2 * bce
     return dice
 
 
+def bceDiceLoss(input, target, train=True):
+    num = target.size(0)
+    return _bce_dice_loss_per_channel(input.reshape(num, 1, -1), target.reshape(num, 1, -1), train)[0]
+
+
 def dice_coeff(input, target):
     smooth = 1e-5
     num = target.size(0)
@@ -544,136 +766,123 @@ def dice_coeff(input, target):
 
 # Segmentation Losses
 
-def get_loss(dataset):
+def get_loss(dataset, dtype=torch.float32, debug=False):
     loss_fun_name = dataset + '_dice_loss'
-    loss_fun = globals()[loss_fun_name]
-    return loss_fun
-
-def lidc_dice_loss(input, target, train=True):
+    loss_fun = functools.partial(globals()[loss_fun_name], debug=debug)
+    if dtype == torch.float32:
+        return loss_fun
+    if dtype == torch.float16:
+        print('WARNING: The float16 loss can overflow or underflow, bfloat16 is safer\n')
+    def autocast_loss_fun(input, target, train=True):
+        # Under autocast the dice dot products run in the lower precision, while the sums and the BCE are still reduced in FP32
+        with torch.autocast(device_type=input.device.type, dtype=dtype):
+            return loss_fun(input, target, train).float()
+    return autocast_loss_fun
+
+def lidc_dice_loss(input, target, train=True, debug=False):
     loss = bceDiceLoss(input, target, train)
-    print(f'loss: {loss}')
+    if debug:
+        print(f'loss: {loss}')
     return loss
 
-def brats_dice_loss(input, target, train=True):
-    wt_loss = bceDiceLoss(input[:, 0], target[:, 0], train)
-    tc_loss = bceDiceLoss(input[:, 1], target[:, 1], train)
-    et_loss = bceDiceLoss(input[:, 2], target[:, 2], train)
-    print(f'wt loss: {wt_loss}, tc_loss : {tc_loss}, et_loss: {et_loss}')
+def brats_dice_loss(input, target, train=True, debug=False):
+    wt_loss, tc_loss, et_loss = _bce_dice_loss_per_channel(input[:, :3], target[:, :3], train)  # All three tumor regions in one call
+    if debug:
+        print(f'wt loss: {wt_loss}, tc_loss : {tc_loss}, et_loss: {et_loss}')
     return wt_loss + tc_loss + et_loss
 
-def lits_dice_loss(input, target, train=True):
+def lits_dice_loss(input, target, train=True, debug=False):
     loss = bceDiceLoss(input, target, train)
-    print(f'loss: {loss}')
+    if debug:
+        print(f'loss: {loss}')
     return loss
 
 
 # Clustering Losses
 
-def ce_loss(gt, out):
-    loss = - torch.mean(gt * torch.log(out))
+def ce_loss(gt, log_out):
+    # Takes log-probabilities (from log_softmax), which is numerically stable and saves a separate log pass over the probabilities
+    if not gt.is_floating_point():  # Cluster ids (B x H x W x D) instead of a one-hot: the same mean over B x K x H x W x D, without the one-hot
+        return F.nll_loss(log_out, gt) / log_out.shape[1]
+    loss = - torch.mean(gt * log_out)
     return loss
 
-def swav_loss(gt1, gt2, out1, out2):
+def swav_loss(gt1, gt2, out1, out2):  # out1, out2 are log-probabilities
     loss1 = ce_loss(gt1,out2)
     loss2 = ce_loss(gt2,out1)
     loss = 0.5 * (loss1 + loss2)
     return loss
 
 
-def sinkhorn(args, Q: torch.Tensor, nmb_iters: int) -> torch.Tensor:
-    with torch.no_grad():
-        sum_Q = torch.sum(Q)
-        Q /= sum_Q
+@functools.lru_cache(maxsize=None)
+def compiled(fn):
+    # Compile a function with torch.compile only once and reuse it (Default mode, because CUDA graphs would overwrite outputs that are still in use between calls)
+    return torch.compile(fn)
 
-        K, B = Q.shape
 
-        if not args.cpu:
-            u = torch.zeros(K).cuda()
-            r = torch.ones(K).cuda() / K
-            c = torch.ones(B).cuda() / B
-        else:
-            u = torch.zeros(K)
-            r = torch.ones(K) / K
-            c = torch.ones(B) / B
+def _sinkhorn_codes(cos_sim, eps: float, nmb_iters: int):
+    K = cos_sim.shape[-1]
+    Q = torch.exp(cos_sim.reshape(-1, K).t() / eps)  # B x N x K -> K x B*N
+    Q = Q / torch.sum(Q)
+    # Uniform marginals (on the same device as Q)
+    r = torch.full((K,), 1 / K, device=Q.device)
+    c = torch.full((Q.shape[1],), 1 / Q.shape[1], device=Q.device)
+    for _ in range(nmb_iters):
+        Q = Q * (r / torch.sum(Q, dim=1)).unsqueeze(1)
+        Q = Q * (c / torch.sum(Q, dim=0)).unsqueeze(0)
+    return Q / torch.sum(Q, dim=0, keepdim=True)
+
 
-        for _ in range(nmb_iters):
-            u = torch.sum(Q, dim=1)
+def sinkhorn_codes(args, cos_sim: torch.Tensor, eps: float, nmb_iters: int) -> torch.Tensor:
+    # Sinkhorn assignments (K x B*N) of the similarities (B x N x K) to the prototypes, including the exp(cos_sim / eps) step
+    # (when compiled, the exp, the transpose and the normalizations are fused into a few kernels)
+    with torch.no_grad():
+        codes = compiled(_sinkhorn_codes) if args.compile else _sinkhorn_codes
+        return codes(cos_sim.float(), eps, nmb_iters)
 
-            Q *= (r / u).unsqueeze(1)
-            Q *= (c / torch.sum(Q, dim=0)).unsqueeze(0)
 
-        return (Q / torch.sum(Q, dim=0, keepdim=True)).t().float()
+def _resize_index(start, end, size):
+    # Source indices that resize each crop [start, end) of a batch to size, like F.interpolate(mode='nearest') does
+    length = (end - start).long().unsqueeze(1)  # B x 1
+    # An empty or inverted crop intersection (end <= start) would silently index outside of it, so fail loudly like interpolate did
+    # (checked on the device, so there is no sync; an error is raised at the next synchronizing call)
+    torch._assert_async((length > 0).all())
+    i = torch.arange(size, device=start.device)
+    return start.long().unsqueeze(1) + torch.minimum(i * length // size, length - 1)  # B x size
 
 
 def roi_align_intersect(pred1, pred2, gt1, gt2, box1, box2):
-    # Cluster assignments to align for crop 1 and crop 2: pred1, pred2, gt1, gt2
+    # Cluster assignments to align for crop 1 and crop 2: pred1, pred2, gt1, gt2 (gt1, gt2 can also be B x H x W x D cluster ids)
     # Coordinates of the crop bounding box : box1, box2
 
-    # Input Crop dimensions (Original, before standardizing to one common size for batchification)
-    H1 = box1[:,1] - box1[:,0]
-    W1 = box1[:,3] - box1[:,2]
-    D1 = box1[:,5] - box1[:,4]
-    H2 = box2[:,1] - box2[:,0]
-    W2 = box2[:,3] - box2[:,2]
-    D2 = box2[:,5] - box2[:,4]
-
     # Output Dimensions
     B, K, H, W, D = pred1.shape
 
-    # Convert to float
-    pred1 = pred1.float()
-    pred2 = pred2.float()
-    gt1 = gt1.float()
-    gt2 = gt2.float()
+    # Compute the coordinates for all axes at once: B x 6 -> B x 3 (x, y, z) x 2 (start, end)
+    box1 = box1.reshape(B,3,2)
+    box2 = box2.reshape(B,3,2)
+    out_size = torch.tensor([H, W, D], device=box1.device).view(1,3,1)
+
+    # Input Crop dimensions (Original, before standardizing to one common size for batchification)
+    size1 = (box1[:,:,1] - box1[:,:,0]).unsqueeze(2)
+    size2 = (box2[:,:,1] - box2[:,:,0]).unsqueeze(2)
 
     # Calculate interesection box of the two crop bounding boxes
-    x1 = torch.maximum(box1[:,0], box2[:,0])
-    x2 = torch.minimum(box1[:,1], box2[:,1])
-    y1 = torch.maximum(box1[:,2], box2[:,2])
-    y2 = torch.minimum(box1[:,3], box2[:,3])
-    z1 = torch.maximum(box1[:,4], box2[:,4])
-    z2 = torch.minimum(box1[:,5], box2[:,5])
-
-    # Coordinates of intersecting box inside bbox 1 (percentage coordinates)
-    x1_1 = (x1-box1[:,0]) / H1
-    x1_2 = (x2-box1[:,0]) / H1
-    y1_1 = (y1-box1[:,2]) / W1
-    y1_2 = (y2-box1[:,2]) / W1
-    z1_1 = (z1-box1[:,4]) / D1
-    z1_2 = (z2-box1[:,4]) / D1
-
-    # Coordinates of intersecting box inside bbox 2 (percentage coordinates)
-    x2_1 = (x1-box2[:,0]) / H2
-    x2_2 = (x2-box2[:,0]) / H2
-    y2_1 = (y1-box2[:,2]) / W2
-    y2_2 = (y2-box2[:,2]) / W2
-    z2_1 = (z1-box2[:,4]) / D2
-    z2_2 = (z2-box2[:,4]) / D2
-
-    # Convert percentage coordinates to coordinates in output
-    x1_1 = (x1_1 * H).int()
-    x1_2 = (x1_2 * H).int()
-    y1_1 = (y1_1 * W).int()
-    y1_2 = (y1_2 * W).int()
-    z1_1 = (z1_1 * D).int()
-    z1_2 = (z1_2 * D).int()
-    x2_1 = (x2_1 * H).int()
-    x2_2 = (x2_2 * H).int()
-    y2_1 = (y2_1 * W).int()
-    y2_2 = (y2_2 * W).int()
-    z2_1 = (z2_1 * D).int()
-    z2_2 = (z2_2 * D).int()
-
-    # Align
-    device = pred1.device
-    roi_pred1 = torch.zeros(size=pred1.shape).to(device)
-    roi_pred2 = torch.zeros(size=pred2.shape).to(device)
-    roi_gt1 = torch.zeros(size=gt1.shape).to(device)
-    roi_gt2 = torch.zeros(size=gt2.shape).to(device)
-    for b_idx in range(B):
-        roi_pred1[b_idx] = F.interpolate(pred1[b_idx, :, x1_1[b_idx]:x1_2[b_idx], y1_1[b_idx]:y1_2[b_idx], z1_1[b_idx]:z1_2[b_idx]].unsqueeze(0), size=(H,W,D))
-        roi_pred2[b_idx] = F.interpolate(pred2[b_idx, :, x2_1[b_idx]:x2_2[b_idx], y2_1[b_idx]:y2_2[b_idx], z2_1[b_idx]:z2_2[b_idx]].unsqueeze(0), size=(H,W,D))
-        roi_gt1[b_idx] = F.interpolate(gt1[b_idx, :, x1_1[b_idx]:x1_2[b_idx], y1_1[b_idx]:y1_2[b_idx], z1_1[b_idx]:z1_2[b_idx]].unsqueeze(0), size=(H,W,D))
-        roi_gt2[b_idx] = F.interpolate(gt2[b_idx, :, x2_1[b_idx]:x2_2[b_idx], y2_1[b_idx]:y2_2[b_idx], z2_1[b_idx]:z2_2[b_idx]].unsqueeze(0), size=(H,W,D))
-
-    return roi_pred1, roi_pred2, roi_gt1, roi_gt2
\ No newline at end of file
+    inter = torch.stack((torch.maximum(box1[:,:,0], box2[:,:,0]), torch.minimum(box1[:,:,1], box2[:,:,1])), dim=2)
+
+    # Coordinates of intersecting box inside bbox 1 and bbox 2 (percentage coordinates), converted to coordinates in output
+    coords1 = ((inter - box1[:,:,:1]) / size1 * out_size).int()
+    coords2 = ((inter - box2[:,:,:1]) / size2 * out_size).int()
+
+    # Align (crop the intersection of every sample and resize it back to H x W x D in one gather per tensor, instead of a loop of interpolations)
+    # (An index gather rather than grid_sample: it keeps the exact nearest neighbour assignments, needs no float sampling grid and works on integer ground truth too)
+    b_idx = torch.arange(B, device=pred1.device).view(B,1,1,1)
+    idx1 = (b_idx, _resize_index(coords1[:,0,0], coords1[:,0,1], H).view(B,H,1,1), _resize_index(coords1[:,1,0], coords1[:,1,1], W).view(B,1,W,1), _resize_index(coords1[:,2,0], coords1[:,2,1], D).view(B,1,1,D))
+    idx2 = (b_idx, _resize_index(coords2[:,0,0], coords2[:,0,1], H).view(B,H,1,1), _resize_index(coords2[:,1,0], coords2[:,1,1], W).view(B,1,W,1), _resize_index(coords2[:,2,0], coords2[:,2,1], D).view(B,1,1,D))
+    roi_pred1 = pred1.permute(0,2,3,4,1)[idx1].permute(0,4,1,2,3)  # B x K x H x W x D -> B x H x W x D x K -(Gather)-> B x H x W x D x K -> B x K x H x W x D
+    roi_pred2 = pred2.permute(0,2,3,4,1)[idx2].permute(0,4,1,2,3)
+    roi_gt1 = gt1[idx1] if gt1.dim() == 4 else gt1.permute(0,2,3,4,1)[idx1].permute(0,4,1,2,3)
+    roi_gt2 = gt2[idx2] if gt2.dim() == 4 else gt2.permute(0,2,3,4,1)[idx2].permute(0,4,1,2,3)
+
+    # Convert to float only what is not already (e.g. one-hot ground truth), after the gather and not on the full inputs (cluster ids stay integer)
+    return tuple(roi if roi.is_floating_point() or roi.dim() == 4 else roi.float() for roi in (roi_pred1, roi_pred2, roi_gt1, roi_gt2))
\ No newline at end of file
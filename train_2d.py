@@ -26,8 +26,10 @@ def Normalize(x):
 
 def moment_update(model, model_ema, m):
     """ model_ema = m * model_ema + (1 - m) model """
-    for p1, p2 in zip(model.parameters(), model_ema.parameters()):
-        p2.data.mul_(m).add_(1 - m, p1.detach().data)
+    with torch.no_grad():  # One fused kernel per dtype for all the parameters, instead of two per parameter
+        params_ema = list(model_ema.parameters())
+        torch._foreach_mul_(params_ema, m)
+        torch._foreach_add_(params_ema, list(model.parameters()), alpha=1 - m)
 
 
 def get_shuffle_ids(bsz):
@@ -177,7 +179,7 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
 
         local_loss = 0.0
 
-        local_input = torch.cat(local_views, dim=0) 
+        local_input = local_views  # Already stacked by the loader (local_views_collate)
 
         # Convert 3D local views to 2D
         BL, _, HL, WL, DL = local_input.shape # BL = 6 * B 
@@ -190,14 +192,14 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
         decoder_outputs1 = [[t[0][:B*DL,:], t[1][:B*DL,:]] for t in decoder_outputs1]
         decoder_outputs2 = [[t[0][:B*DL,:], t[1][:B*DL,:]] for t in decoder_outputs2]
 
-        for i in range(len(local_views)):
+        for i in range(BL // B):
             local_views_outputs_tmp = [t[:, B * DL * i: B * DL * (i + 1)] for t in local_views_outputs]  # We use B * DL and not BL * BD because BL = B*6 and we iterate over the 6 local views
             loss_local_1, _ = cos_loss(cosine, decoder_outputs1, local_views_outputs_tmp)
             loss_local_2, _ = cos_loss(cosine, decoder_outputs2, local_views_outputs_tmp)
             local_loss += loss_local_1
             local_loss += loss_local_2
 
-        local_loss = local_loss / (DL * 2 * len(local_views))
+        local_loss = local_loss / (DL * 2 * (BL // B))
         loss1 = criterion(mask1, gt1) / D
         beta = 0.5 * (1. + math.cos(math.pi * epoch / 240))
         loss4 = beta * criterion(middle_masks1[index2], gt1) / D
@@ -211,10 +213,10 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
         optimizer.step()
 
         # Meters
-        mg_loss_meter.update(loss1.item(), B)
-        loss_meter.update(loss2.item(), B)
+        mg_loss_meter.update(loss1, B)
+        loss_meter.update(loss2, B)
         prob_meter.update(local_loss, B)
-        total_loss_meter.update(loss.item(), B)
+        total_loss_meter.update(loss, B)
         if not args.cpu:
             torch.cuda.synchronize()
         batch_time.update(time.time() - end)
@@ -279,9 +281,9 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
             pred1 = model.module(x1)
             pred2 = model.module(x2)
             
-            # Convert to probabilities
-            pred1 = pred1.softmax(2)
-            pred2 = pred2.softmax(2)
+            # Convert to log-probabilities (for a stable cross-entropy)
+            pred1 = pred1.log_softmax(2)
+            pred2 = pred2.log_softmax(2)
 
         # ROI-align crop intersection with cluster assignment intersection
         roi_pred1, roi_pred2, roi_gt1, roi_gt2 = roi_align_intersect(pred1, pred2, gt1, gt2, crop1_coords, crop2_coords)
@@ -317,20 +319,11 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
                 gt1 = gt1.cpu().detach()
                 gt2 = gt2.cpu().detach()
 
-                # Give color to each cluster in cluster masks
-                pred1 = pred1.repeat((3,1,1)).permute(1,2,0).float()  # Convert to RGB and move channel dim to the end
-                pred2 = pred2.repeat((3,1,1)).permute(1,2,0).float()
-                gt1 = gt1.repeat((3,1,1)).permute(1,2,0).float()
-                gt2 = gt2.repeat((3,1,1)).permute(1,2,0).float()
-                for c in range(colors.shape[0]):
-                    pred1[pred1[:,:,0] == c] = colors[c]
-                    pred2[pred2[:,:,0] == c] = colors[c]
-                    gt1[gt1[:,:,0] == c] = colors[c]
-                    gt2[gt2[:,:,0] == c] = colors[c]
-                pred1 = pred1.permute(2,1,0)
-                pred2 = pred2.permute(2,1,0)
-                gt1 = gt1.permute(2,0,1)
-                gt2 = gt2.permute(2,0,1)
+                # Give color to each cluster in cluster masks (index the palette with the cluster ids)
+                pred1 = colors[pred1[0]].permute(2,1,0)  # 1 x H x W -> H x W x 3 -> 3 x W x H
+                pred2 = colors[pred2[0]].permute(2,1,0)
+                gt1 = colors[gt1[0]].permute(2,0,1)  # 1 x H x W -> H x W x 3 -> 3 x H x W
+                gt2 = colors[gt2[0]].permute(2,0,1)
 
                 # Pad images for better visualization                
                 in1 = f.pad(in1.unsqueeze(0),(2,1,2,2),value=1)
@@ -369,10 +362,10 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
         optimizer.step()
 
         # Meters
-        mg_loss_meter.update(loss1.item(), B)
-        loss_meter.update(loss2.item(), B)
+        mg_loss_meter.update(loss1, B)
+        loss_meter.update(loss2, B)
         prob_meter.update(local_loss, B)
-        total_loss_meter.update(loss.item(), B)
+        total_loss_meter.update(loss, B)
         if not args.cpu:
             torch.cuda.synchronize()
         batch_time.update(time.time() - end)
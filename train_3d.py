@@ -12,17 +12,21 @@ import random
 import PIL
 import numpy as np
 import seaborn as sns
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 
 
 import torch
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as f
 import torchvision.transforms.functional as t
+from torch import autocast
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 
 from models import PCRLv23d, Cluster3d, ClusterPatch3d, TraceWrapper
-from tools import adjust_learning_rate, AverageMeter, sinkhorn, ce_loss, swav_loss, roi_align_intersect
+from tools import adjust_learning_rate, AverageMeter, sinkhorn_codes, ce_loss, swav_loss, roi_align_intersect, compiled, AsyncCheckpointer, seed_worker, worker_kwargs, is_main_process, any_process, input_memory_format, CudaPrefetcher, StepTimer
 
 
 def Normalize(x):
@@ -33,16 +37,25 @@ def Normalize(x):
 
 def moment_update(model, model_ema, m):
     """ model_ema = m * model_ema + (1 - m) model """
-    for p1, p2 in zip(model.parameters(), model_ema.parameters()):
-        p2.data.mul_(m).add_(1 - m, p1.detach().data)
+    with torch.no_grad():  # One fused kernel per dtype for all the parameters, instead of two per parameter
+        params_ema = list(model_ema.parameters())
+        torch._foreach_mul_(params_ema, m)
+        torch._foreach_add_(params_ema, list(model.parameters()), alpha=1 - m)
 
 
-def cos_loss(cosine, output1, output2):
-    index = random.randint(0, len(output1) - 1)  # Because we select a feature map from a random scale
+def normalize_outputs(outputs):
+    # Stack the (projection, prediction) features of each scale and L2-normalize them over the channels once (in FP32, they are small),
+    # so that cos_loss only multiplies and sums them, however many times a scale is compared
+    return [f.normalize(torch.stack(t).float(), dim=-1) for t in outputs]
+
+
+def cos_loss(output1, output2, index=None):
+    # Cosine loss between normalized outputs (see normalize_outputs)
+    if index is None:
+        index = random.randint(0, len(output1) - 1)  # Because we select a feature map from a random scale
     sample1 = output1[index]
     sample2 = output2[index]
-    loss = -(cosine(sample1[1], sample2[0].detach()).mean() + cosine(sample2[1],
-                                                                     sample1[0].detach()).mean()) * 0.5
+    loss = -((sample1[1] * sample2[0].detach()).sum(-1).mean() + (sample2[1] * sample1[0].detach()).sum(-1).mean()) * 0.5
     return loss, index
 
 
@@ -51,16 +64,19 @@ def train_3d(args, data_loader, run_dir, writer=None):
     if 'cluster' in args.model:
         # Generate colors for cluster masks
         palette = sns.color_palette(palette='bright', n_colors=args.k)
-        colors = torch.Tensor([list(color) for color in palette])
-        if args.cpu:
-            colors = colors.cpu()
-        else:
-            colors = colors.cuda()
-
-    torch.backends.cudnn.deterministic = True
+        colors = torch.tensor(palette, dtype=torch.float32, device='cpu' if args.cpu else 'cuda')  # K x 3 lookup table, indexed by the cluster ids
 
     train_loader = data_loader['train']
     val_loader = data_loader['eval']
+    train_sampler = None
+    if dist.is_initialized():  # Each process loads its own shard of the training set (and a share of the batch size)
+        world_size = dist.get_world_size()
+        assert args.b >= world_size and args.b % world_size == 0, f'The batch size ({args.b}) must be a multiple of the number of processes ({world_size})'
+        train_sampler = DistributedSampler(train_loader.dataset, seed=args.seed)
+        train_loader = DataLoader(train_loader.dataset, batch_size=args.b // world_size, sampler=train_sampler,
+                                  pin_memory=True, num_workers=args.workers, worker_init_fn=seed_worker, collate_fn=train_loader.collate_fn, **worker_kwargs(args.workers))
+    if not args.cpu:
+        train_loader = CudaPrefetcher(train_loader)  # Copy the next batch to the GPU (side stream) while the current one is trained on
 
     # Create model and optimizer
     if args.model == 'pcrlv2':
@@ -69,44 +85,58 @@ def train_3d(args, data_loader, run_dir, writer=None):
         model = Cluster3d(n_clusters=args.k, seed=args.seed, skip_conn=args.skip_conn)
     elif args.model == 'cluster_patch':
         model = ClusterPatch3d(n_clusters=args.k, seed=args.seed, skip_conn=args.skip_conn)
+    model.grad_ckpt = args.grad_ckpt  # Recompute block activations in the backward (less memory for larger batches)
     if not args.cpu:
         model = model.cuda()
+        if args.channels_last:  # NDHWC weights for the faster cuDNN tensor-core kernels of the 3D convs
+            model = model.to(memory_format=torch.channels_last_3d)
 
     optimizer = torch.optim.SGD(model.parameters(),
                                 lr=args.lr,
                                 momentum=args.momentum,
                                 weight_decay=args.weight_decay)
-    model = nn.DataParallel(model)
+    # Loss scaling is only needed for float16 (bfloat16 has the range of float32)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and args.amp_dtype == 'float16' and not args.cpu)
+
+    if dist.is_initialized():  # One process per GPU (launched with torchrun), gradients are all-reduced during the backward
+        local_rank = torch.cuda.current_device()
+        # Some heads are unused in each step (e.g. the scales not selected by cos_loss, the pcrlv2 heads of the cluster model)
+        model = DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank, find_unused_parameters=True)
+    else:
+        model = nn.DataParallel(model)
 
     if args.model == 'pcrlv2':
         criterion = nn.MSELoss()
-        cosine = nn.CosineSimilarity()
         if not args.cpu:
             criterion = criterion.cuda()
-            cosine = cosine.cuda()
 
     grid_pred = []  # Grid for visualizing predictions at each epoch
+    checkpointer = AsyncCheckpointer()  # Save checkpoints without blocking the next epoch on pickling and disk writes
 
     for epoch in range(0, args.epochs + 1):
 
         # TRAINING
 
         adjust_learning_rate(epoch, args, optimizer)
-        print("==> Training...")
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)  # Different shuffling at each epoch
+        if is_main_process():
+            print("==> Training...")
 
         time1 = time.time()
 
         if args.model == 'pcrlv2':
-            _, _, total_loss, writer = train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, cosine, writer)
+            _, _, total_loss, writer = train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, scaler, criterion, writer)
         elif args.model == 'cluster':
-            _, _, total_loss, writer = train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, colors)
+            _, _, total_loss, writer = train_cluster_inner(args, epoch, train_loader, model, optimizer, scaler, writer, colors)
         elif args.model == 'cluster_patch':
-            _, _, total_loss, writer = train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, writer, colors)
+            _, _, total_loss, writer = train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, scaler, writer, colors)
 
         time2 = time.time()
-        print('epoch {}, total time {:.2f}'.format(epoch, time2 - time1))
+        if is_main_process():
+            print('epoch {}, total time {:.2f}'.format(epoch, time2 - time1))
 
-        if args.tensorboard:
+        if args.tensorboard and writer:
             writer.add_scalar('loss/train', total_loss, epoch)  # Write train loss on tensorboard
 
 
@@ -116,7 +146,7 @@ def train_3d(args, data_loader, run_dir, writer=None):
         n_epochs = min(N,args.epochs) # The number of epochs to sample for the grid (N or all epochs if total less than N)
         step_epochs =  args.epochs // n_epochs # Every how many epochs to sample
         
-        if args.vis and (epoch % step_epochs == 0) and (epoch / step_epochs) <= n_epochs and 'cluster' in args.model:  
+        if args.vis and writer and (epoch % step_epochs == 0) and (epoch / step_epochs) <= n_epochs and 'cluster' in args.model:  
 
             print("==> Validating...")
             
@@ -126,32 +156,16 @@ def train_3d(args, data_loader, run_dir, writer=None):
             elif args.model == 'cluster_patch':
                 grid_pred.extend(val_cluster_patch_inner(args, epoch, val_loader, model, colors, N))  # Array of a row for each scale to add to the grid of each scale
             
-            n_cols = min(N,args.b)
-            n_rows = len(grid_pred) // n_cols
-            
-            # Plot grid of predictions for sampled epochs up to now
-            fig, axes = plt.subplots(n_rows, n_cols, figsize=(15, 15*(n_rows/n_cols)))
-            for i, ax in enumerate(axes.flat):
-                ax.imshow(grid_pred[i]) 
-                ax.axis('off')  # Turn off axis labels
-                if i % n_cols:
-                    ax.set_ylabel(f'Epoch {epoch}', rotation=0, size='large')
-            plt.tight_layout()  # Adjust spacing between subplots
-            # Save grid to buffer and then log on tensorboard
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-            buf.seek(0)
-            grid = PIL.Image.open(buf)
-            grid = t.pil_to_tensor(grid)
-            writer.add_image(f'img/val/grid', img_tensor=grid, global_step=epoch)
+            # Plot grid of predictions for sampled epochs up to now (in the background, training goes on)
+            writer.background(log_grid, writer, list(grid_pred), min(N,args.b), epoch)
 
         # Save model
-        if epoch % 100 == 0 or epoch == 240:
+        if (epoch % 100 == 0 or epoch == 240) and is_main_process():
             print('==> Saving...')
             state = {'opt': args, 'state_dict': model.module.state_dict(),
                      'optimizer': optimizer.state_dict(), 'epoch': epoch}
             save_file = run_dir + '.pt'
-            torch.save(state, save_file)
+            checkpointer.save(state, save_file)  # Waits only for the copy to CPU, the file is written in the background
 
             # Help release GPU memory
             del state
@@ -159,13 +173,63 @@ def train_3d(args, data_loader, run_dir, writer=None):
         if not args.cpu:
             torch.cuda.empty_cache()
 
+    checkpointer.wait()  # Make sure the last checkpoint is on disk before returning
+
         
-def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, cosine, writer):
+def render_pair(in1, in2, pred1, pred2, gt1, gt2, colors):
+    # Side by side (crop 1 | crop 2) input, prediction and ground truth images, from 1 x H x W input slices and H x W cluster ids
+    # Min-max norm input images
+    in1 = (in1 - in1.min())/(in1.max() - in1.min())
+    in2 = (in2 - in2.min())/(in2.max() - in2.min())
+    # Give color to each cluster in cluster masks (index the palette with the cluster ids: H x W -> H x W x 3 -> 3 x H x W)
+    pred1 = colors[pred1].permute(2,0,1)
+    pred2 = colors[pred2].permute(2,0,1)
+    gt1 = colors[gt1].permute(2,0,1)
+    gt2 = colors[gt2].permute(2,0,1)
+    # Pad images for better visualization
+    in1 = f.pad(in1.unsqueeze(0),(2,1,2,2),value=1)
+    in2 = f.pad(in2.unsqueeze(0),(1,2,2,2),value=1)
+    pred1 = f.pad(pred1.unsqueeze(0),(2,1,2,2),value=1)
+    pred2 = f.pad(pred2.unsqueeze(0),(1,2,2,2),value=1)
+    gt1 = f.pad(gt1.unsqueeze(0),(2,1,2,2),value=1)
+    gt2 = f.pad(gt2.unsqueeze(0),(1,2,2,2),value=1)
+    # Combine crops
+    in_img = torch.cat((in1,in2),dim=3).squeeze(0)
+    pred_img = torch.cat((pred1,pred2),dim=3).squeeze(0)
+    gt_img = torch.cat((gt1,gt2),dim=3).squeeze(0)
+    return in_img, pred_img, gt_img
+
+
+def log_grid(writer, grid_pred, n_cols, epoch):
+    # Runs in the visualization thread of the writer (so it uses a Figure directly, because pyplot is not thread-safe)
+    n_rows = len(grid_pred) // n_cols
+    fig = Figure(figsize=(15, 15*(n_rows/n_cols)))
+    axes = fig.subplots(n_rows, n_cols, squeeze=False)
+    for i, ax in enumerate(axes.flat):
+        ax.imshow(grid_pred[i]) 
+        ax.axis('off')  # Turn off axis labels
+        if i % n_cols:
+            ax.set_ylabel(f'Epoch {epoch}', rotation=0, size='large')
+    fig.tight_layout()  # Adjust spacing between subplots
+    # Save grid to buffer and then log on tensorboard
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight', dpi=100)
+    buf.seek(0)
+    grid = PIL.Image.open(buf)
+    grid = t.pil_to_tensor(grid)
+    writer.add_image(f'img/val/grid', img_tensor=grid, global_step=epoch)
+
+
+def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, scaler, criterion, writer):
     """
     one epoch training for instance discrimination
     """
     
     model.train()
+    device_type = 'cpu' if args.cpu else 'cuda'
+    amp_dtype = getattr(torch, args.amp_dtype)
+    memory_format = input_memory_format(args)
+    net = model.module if args.cpu else model  # DataParallel refuses CPU parameters on a CUDA host
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -173,6 +237,7 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
     mg_loss_meter = AverageMeter()
     prob_meter = AverageMeter()
     total_loss_meter = AverageMeter()
+    step_timer = StepTimer(cuda=not args.cpu)
 
     end = time.time()
     for idx, (input1, input2, gt1, gt2, _, _, local_views, _) in enumerate(train_loader):
@@ -180,58 +245,64 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
         B, C, H, W, D = input1.shape
 
         data_time.update(time.time() - end)
+        step_timer.start()
 
         bsz = input1.size(0)
-        x1 = input1.float()  # Crop 1
-        x2 = input2.float()  # Crop 2
-
-        if not args.cpu:
-            x1 = x1.cuda()
-            x2 = x2.cuda()
-            gt1 = gt1.cuda()
-            gt2 = gt2.cuda()
-
-        # Get predictions
-        mask1, decoder_outputs1, middle_masks1 = model(x1)
-        _, decoder_outputs2, _ = model(x2)
-
-        loss2, index2 = cos_loss(cosine, decoder_outputs1, decoder_outputs2)
-        local_loss = 0.0
-
-        local_input = torch.cat(local_views, dim=0)  # 6 * bsz, 3, d, 96, 96
-        _, local_views_outputs, _ = model(local_input, local=True)  # 4 * 2 * [6 * bsz, 3, d, 96, 96]
-        local_views_outputs = [torch.stack(t) for t in local_views_outputs]
-        
-        for i in range(len(local_views)):
-            local_views_outputs_tmp = [t[:, bsz * i: bsz * (i + 1)] for t in local_views_outputs]
-            loss_local_1, _ = cos_loss(cosine, decoder_outputs1, local_views_outputs_tmp)
-            loss_local_2, _ = cos_loss(cosine, decoder_outputs2, local_views_outputs_tmp)
-            local_loss += loss_local_1
-            local_loss += loss_local_2
-        local_loss = local_loss / (2 * len(local_views))
-        loss1 = criterion(mask1, gt1)
-        beta = 0.5 * (1. + math.cos(math.pi * epoch / 240))
-        loss4 = beta * criterion(middle_masks1[index2], gt1)  
+        x1 = input1.to(dtype=torch.float, memory_format=memory_format)  # Crop 1 (the batch is already on the GPU, so the cast also happens there)
+        x2 = input2.to(dtype=torch.float, memory_format=memory_format)  # Crop 2
+
+        with autocast(device_type=device_type, dtype=amp_dtype, enabled=args.amp):  # Run the forwards and losses in mixed precision
+            # Get predictions
+            if args.fuse_crops:  # Both crops in one forward (a bigger batch, but the batch norm statistics are computed over both crops)
+                mask1, decoder_outputs, middle_masks1 = net(torch.cat((x1, x2), dim=0))
+                decoder_outputs = normalize_outputs(decoder_outputs)  # 3 * [2, 2 * bsz, C]
+                decoder_outputs1 = [t[:, :bsz] for t in decoder_outputs]
+                decoder_outputs2 = [t[:, bsz:] for t in decoder_outputs]
+                mask1 = mask1[:bsz]
+                middle_masks1 = [m[:bsz] for m in middle_masks1]
+            else:
+                mask1, decoder_outputs1, middle_masks1 = net(x1)
+                _, decoder_outputs2, _ = net(x2)
+                decoder_outputs1 = normalize_outputs(decoder_outputs1)  # 3 * [2, bsz, C]
+                decoder_outputs2 = normalize_outputs(decoder_outputs2)
+
+            index = random.randint(0, len(decoder_outputs1) - 1)  # One random scale for all the cosine losses of the step
+            loss2, _ = cos_loss(decoder_outputs1, decoder_outputs2, index)
+
+            local_input = local_views.to(dtype=torch.float, memory_format=memory_format)  # 6 * bsz, 3, d, 96, 96 (already stacked by the loader)
+            _, local_views_outputs, _ = net(local_input, local=True)  # 4 * 2 * [6 * bsz, 3, d, 96, 96]
+            local_views_outputs = normalize_outputs(local_views_outputs)
+            # Separate the local views (2 x 6 * bsz x C -> 2 x 6 x bsz x C), so that the global outputs are compared with all of them at once
+            local_views_outputs = [t.reshape(t.shape[0], local_input.shape[0] // bsz, bsz, *t.shape[2:]) for t in local_views_outputs]
+
+            loss_local_1, _ = cos_loss(decoder_outputs1, local_views_outputs, index)
+            loss_local_2, _ = cos_loss(decoder_outputs2, local_views_outputs, index)
+            local_loss = (loss_local_1 + loss_local_2) / 2  # Each is already the mean over the local views
+            loss1 = criterion(mask1, gt1)
+            beta = 0.5 * (1. + math.cos(math.pi * epoch / 240))
+            loss4 = beta * criterion(middle_masks1[index], gt1)  
         
         # Total Loss
         loss = loss1 + loss2 + loss4 + local_loss
 
         # Backward
-        if loss > 1000 and epoch > 10:
-            print('skip the step')
+        if epoch > 10 and any_process(loss > 1000):  # All processes skip together (otherwise the gradient all-reduce would hang)
+            if is_main_process():
+                print('skip the step')
             continue
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)  # Drop the gradients instead of writing zeros to them
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # Meters
-        mg_loss_meter.update(loss1.item(), bsz)
-        loss_meter.update(loss2.item(), bsz)
+        mg_loss_meter.update(loss1, bsz)
+        loss_meter.update(loss2, bsz)
         prob_meter.update(local_loss, bsz)
         total_loss_meter.update(loss, bsz)
-        if not args.cpu:
-            torch.cuda.synchronize()
-        batch_time.update(time.time() - end)
+        step_timer.stop()
+        if (idx + 1) % 10 == 0:
+            batch_time.update(step_timer.elapsed())
         end = time.time()
 
         # if args.tensorboard:
@@ -240,7 +311,7 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
         #         writer.add_graph(model_wrapper, x1)
 
         # Print info
-        if (idx + 1) % 10 == 0:
+        if (idx + 1) % 10 == 0 and is_main_process():
             print('Train: [{0}][{1}/{2}]\t'
                   'BT {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'DT {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -251,16 +322,21 @@ def train_pcrlv2_inner(args, epoch, train_loader, model, optimizer, criterion, c
                 data_time=data_time, c2l_loss=loss_meter, mg_loss=mg_loss_meter, prob=prob_meter))
             sys.stdout.flush()
 
-    return mg_loss_meter.avg, prob_meter.avg, total_loss_meter.avg, writer
+    return mg_loss_meter.avg, prob_meter.avg, total_loss_meter.all_reduce().avg, writer
 
 
 def train_pcrlv2_3d(args, data_loader, run_dir, writer=None):
     train_3d(args, data_loader, run_dir, writer=writer)
 
 
-def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, colors):
+def train_cluster_inner(args, epoch, train_loader, model, optimizer, scaler, writer, colors):
 
     model.train()
+    device_type = 'cpu' if args.cpu else 'cuda'
+    amp_dtype = getattr(torch, args.amp_dtype)
+    memory_format = input_memory_format(args)
+    net = model.module if args.cpu else model
+    render = compiled(render_pair) if args.compile else render_pair  # Compiled, the visualization ops are fused into a few kernels
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -268,6 +344,7 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
     mg_loss_meter = AverageMeter()
     prob_meter = AverageMeter()
     total_loss_meter = AverageMeter()
+    step_timer = StepTimer(cuda=not args.cpu)
 
     end = time.time()
     for idx, (input1, input2, gt1, gt2, crop1_coords, crop2_coords, _, _) in enumerate(train_loader):
@@ -275,96 +352,56 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
         B, C, H, W, D = input1.shape
 
         data_time.update(time.time() - end)
-
-        x1 = input1.float()  # Crop 1
-        x2 = input2.float()  # Crop 2
-
-        if not args.cpu:
-            x1 = x1.cuda()
-            x2 = x2.cuda()
-            gt1 = gt1.cuda()
-            gt2 = gt2.cuda()
-            crop1_coords = crop1_coords.cuda()
-            crop2_coords = crop2_coords.cuda()
-
-        pred1 = model.module(x1)  # Get cluster predictions
-        pred1 = pred1.softmax(2)  # Convert to probabilities
-        gt1 = f.one_hot(gt1.long(), num_classes=args.k).permute(0,4,1,2,3)  # B x H x W x D -> B x H x W x D x K -> B x K x H x W x D
-
-        # Do everything again for the other crop if using swav loss
-        if args.cluster_loss == 'swav':
-            pred2 = model.module(x2)
-            pred2 = pred2.softmax(2)
-            gt2 = f.one_hot(gt2.long(), num_classes=args.k).permute(0,4,1,2,3)
-            # ROI-align crop intersection with cluster assignment intersection
-            roi_pred1, roi_pred2, roi_gt1, roi_gt2 = roi_align_intersect(pred1, pred2, gt1, gt2, crop1_coords, crop2_coords)
-
-        # Clustering Loss
-        if args.cluster_loss == 'ce':
-            cluster_loss = ce_loss(gt1, pred1)
-        elif args.cluster_loss == 'swav':
-            cluster_loss = swav_loss(roi_gt1, roi_gt2, roi_pred1, roi_pred2)
+        step_timer.start()
+
+        x1 = input1.to(dtype=torch.float, memory_format=memory_format)
+        x2 = input2.to(dtype=torch.float, memory_format=memory_format)
+
+        with autocast(device_type=device_type, dtype=amp_dtype, enabled=args.amp):  # Run the forwards and losses in mixed precision
+            pred1 = net(x1)  # Get cluster predictions
+            pred1 = pred1.log_softmax(2)  # Convert to log-probabilities (for a stable cross-entropy)
+            gt1 = gt1.long()  # Cluster ids (B x H x W x D), used by the losses and the visualization directly (no K times larger one-hot)
+
+            # Do everything again for the other crop if using swav loss
+            if args.cluster_loss == 'swav':
+                pred2 = net(x2)
+                pred2 = pred2.log_softmax(2)
+                gt2 = gt2.long()
+                # ROI-align crop intersection with cluster assignment intersection
+                roi_pred1, roi_pred2, roi_gt1, roi_gt2 = roi_align_intersect(pred1, pred2, gt1, gt2, crop1_coords, crop2_coords)
+
+            # Clustering Loss
+            if args.cluster_loss == 'ce':
+                cluster_loss = ce_loss(gt1, pred1)
+            elif args.cluster_loss == 'swav':
+                cluster_loss = swav_loss(roi_gt1, roi_gt2, roi_pred1, roi_pred2)
 
         # Plot predictions on tensorboard
         with torch.no_grad():
             b_idx = 0
-            if args.vis and idx==b_idx: #and epoch % 10 == 0:
+            if args.vis and writer and idx==b_idx and epoch % args.vis_every == 0:
 
                 # Select 2D images
                 img_idx = 0
                 m_idx = 0
                 s_idx = D//2
                 in1 = x1[img_idx,m_idx,:,:,s_idx].unsqueeze(0)
-                pred1 = pred1[img_idx,:,:,:,s_idx].argmax(dim=0).unsqueeze(0)  # Take only hard cluster assignment (argmax)
-                gt1 = gt1[img_idx,:,:,:,s_idx].argmax(dim=0).unsqueeze(0)
-                # Min-max norm input images
-                in1 = (in1 - in1.min())/(in1.max() - in1.min())
-                # Give color to each cluster in cluster masks
-                pred1 = pred1.repeat((3,1,1)).permute(1,2,0).float()  # Convert to RGB and move channel dim to the end
-                gt1 = gt1.repeat((3,1,1)).permute(1,2,0).float()
-                for c in range(colors.shape[0]):
-                    pred1[pred1[:,:,0] == c] = colors[c]
-                    gt1[gt1[:,:,0] == c] = colors[c]
-                pred1 = pred1.permute(2,0,1)
-                gt1 = gt1.permute(2,0,1)
+                pred1 = pred1[img_idx,:,:,:,s_idx].argmax(dim=0)  # Take only hard cluster assignment (argmax)
+                gt1 = gt1[img_idx,:,:,s_idx]
                 if args.cluster_loss == 'ce':
-                    in_img = in1
-                    pred_img = pred1
-                    gt_img = gt1
+                    in_img = (in1 - in1.min())/(in1.max() - in1.min())  # Min-max norm input images
+                    pred_img = colors[pred1].permute(2,0,1)  # Give color to each cluster in cluster masks (H x W -> H x W x 3 -> 3 x H x W)
+                    gt_img = colors[gt1].permute(2,0,1)
 
-                # Do everything again for the other crop if using swav loss
+                # Do everything again for the other crop if using swav loss, and combine crops
                 if args.cluster_loss == 'swav':
                     in2 = x2[img_idx,m_idx,:,:,s_idx].unsqueeze(0)
-                    pred2 = pred2[img_idx,:,:,:,s_idx].argmax(dim=0).unsqueeze(0)
-                    gt2 = gt2[img_idx,:,:,:,s_idx].argmax(dim=0).unsqueeze(0)
-                    in2 = (in2 - in2.min())/(in2.max() - in2.min())
-                    pred2 = pred2.repeat((3,1,1)).permute(1,2,0).float()
-                    gt2 = gt2.repeat((3,1,1)).permute(1,2,0).float()
-                    for c in range(colors.shape[0]):
-                        pred2[pred2[:,:,0] == c] = colors[c]
-                        gt2[gt2[:,:,0] == c] = colors[c]
-                    pred2 = pred2.permute(2,0,1)
-                    gt2 = gt2.permute(2,0,1)
-                    # Pad images for better visualization                
-                    in1 = f.pad(in1.unsqueeze(0),(2,1,2,2),value=1)
-                    in2 = f.pad(in2.unsqueeze(0),(1,2,2,2),value=1)
-                    pred1 = f.pad(pred1.unsqueeze(0),(2,1,2,2),value=1)
-                    pred2 = f.pad(pred2.unsqueeze(0),(1,2,2,2),value=1)
-                    gt1 = f.pad(gt1.unsqueeze(0),(2,1,2,2),value=1)
-                    gt2 = f.pad(gt2.unsqueeze(0),(1,2,2,2),value=1)
-                    # Combine crops
-                    in_img = torch.cat((in1,in2),dim=3).squeeze(0)
-                    pred_img = torch.cat((pred1,pred2),dim=3).squeeze(0)
-                    gt_img = torch.cat((gt1,gt2),dim=3).squeeze(0)
-
-                # Save in tensorboard
-                in_img_name = 'img/train/raw' 
-                pred_img_name = f'img/train/pred'
-                gt_img_name = f'img/train/gt'
-
-                writer.add_image(in_img_name, img_tensor=in_img.cpu().detach().numpy(), global_step=epoch, dataformats='CHW')
-                writer.add_image(pred_img_name, img_tensor=pred_img.cpu().detach().numpy(), global_step=epoch, dataformats='CHW')   
-                writer.add_image(gt_img_name, img_tensor=gt_img.cpu().detach().numpy(), global_step=epoch, dataformats='CHW')
+                    pred2 = pred2[img_idx,:,:,:,s_idx].argmax(dim=0)
+                    gt2 = gt2[img_idx,:,:,s_idx]
+                    in_img, pred_img, gt_img = render(in1, in2, pred1, pred2, gt1, gt2, colors)
+
+                # Save in tensorboard (copied and logged in the background, without waiting for the GPU)
+                writer.add_images_async({'img/train/raw': in_img, 'img/train/pred': pred_img, 'img/train/gt': gt_img}, epoch)
 
         # TODO: add the other losses later
         loss1 = cluster_loss
@@ -377,21 +414,23 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
         loss = loss1
 
         # Backward
-        if loss > 1000 and epoch > 10:
-            print('skip the step')
+        if epoch > 10 and any_process(loss > 1000):
+            if is_main_process():
+                print('skip the step')
             continue
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # Meters
-        mg_loss_meter.update(loss1.item(), B)
-        loss_meter.update(loss2.item(), B)
+        mg_loss_meter.update(loss1, B)
+        loss_meter.update(loss2, B)
         prob_meter.update(local_loss, B)
         total_loss_meter.update(loss, B)
-        if not args.cpu:
-            torch.cuda.synchronize()
-        batch_time.update(time.time() - end)
+        step_timer.stop()
+        if (idx + 1) % 10 == 0:
+            batch_time.update(step_timer.elapsed())
         end = time.time()
 
         # if args.tensorboard:
@@ -400,7 +439,7 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
         #         writer.add_graph(model_wrapper, x1)
 
         # print info
-        if (idx + 1) % 10 == 0:
+        if (idx + 1) % 10 == 0 and is_main_process():
             print('Train: [{0}][{1}/{2}]\t'
                   'BT {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'DT {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -411,11 +450,13 @@ def train_cluster_inner(args, epoch, train_loader, model, optimizer, writer, col
                 data_time=data_time, c2l_loss=loss_meter, mg_loss=mg_loss_meter, prob=prob_meter))
             sys.stdout.flush()
 
-    return mg_loss_meter.avg, prob_meter.avg, total_loss_meter.avg, writer
+    return mg_loss_meter.avg, prob_meter.avg, total_loss_meter.all_reduce().avg, writer
 
 
 def val_cluster_inner(args, epoch, val_loader, model, colors, N):
 
+    memory_format = input_memory_format(args)
+
     with torch.no_grad():
 
         model.eval()
@@ -431,19 +472,17 @@ def val_cluster_inner(args, epoch, val_loader, model, colors, N):
             # Keep only modality 0
             image = image[:,0:1,:,:,:]
 
-            x = image.float()
+            x = image
 
             if not args.cpu:
-                x = x.cuda()
+                x = x.cuda(non_blocking=True)
+            x = x.to(dtype=torch.float, memory_format=memory_format)
 
-            # Get embeddings and predictions
-            pred = model(x)
+            # Get embeddings and predictions (with the unwrapped model, because only the main process validates)
+            pred = model.module(x)
 
             grid_pred = []  # Contains the grid predictions of a specific scale
 
-            # Convert to probabilities
-            pred = pred.softmax(2)
-
             # Gather predictions to visualize on grid
             n_images = min(N,args.b)  # The number of images to sample from for the grid (N or all images if total less than N)
             if epoch == 0:  # If epoch 0, add the input images as the first row of the grid
@@ -455,10 +494,9 @@ def val_cluster_inner(args, epoch, val_loader, model, colors, N):
                     grid_pred.append(x_i)
             else:
                 for img_idx in range(n_images): # If next epochs, add the predictions for each image at the current epoch as the next row
-                    pred_i = pred[img_idx,:,:,:,pred.shape[-1]//2].argmax(dim=0).unsqueeze(0)  # Take only hard cluster assignment (argmax)
-                    pred_i = pred_i.repeat((3,1,1)).permute(1,2,0).float()  # Convert to RGB and move channel dim to the end
-                    for c in range(colors.shape[0]):  # Give color to each cluster in cluster masks
-                        pred_i[pred_i[:,:,0] == c] = colors[c]
+                    # Convert to probabilities (the softmax over dim 2 of the volume, only for the visualized slice) and take only hard cluster assignment (argmax)
+                    pred_i = pred[img_idx,:,:,:,pred.shape[-1]//2].softmax(1).argmax(dim=0)
+                    pred_i = colors[pred_i]  # Give color to each cluster in cluster masks (H x W -> H x W x 3, channel dim at the end)
                     pred_i = pred_i.cpu().detach()
                     grid_pred.append(pred_i)
                 
@@ -469,9 +507,14 @@ def train_cluster_3d(args, data_loader, run_dir, writer=None):
     train_3d(args, data_loader, run_dir, writer=writer)
 
 
-def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, writer, colors):
+def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, scaler, writer, colors):
 
     model.train()
+    device_type = 'cpu' if args.cpu else 'cuda'
+    amp_dtype = getattr(torch, args.amp_dtype)
+    memory_format = input_memory_format(args)
+    net = model.module if args.cpu else model
+    render = compiled(render_pair) if args.compile else render_pair
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
@@ -479,6 +522,7 @@ def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, write
     mg_loss_meter = AverageMeter()
     prob_meter = AverageMeter()
     total_loss_meter = AverageMeter()
+    step_timer = StepTimer(cuda=not args.cpu)
 
     end = time.time()
     for idx, (input1, input2, gt1, gt2, crop1_coords, crop2_coords, _, _) in enumerate(train_loader):
@@ -486,79 +530,62 @@ def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, write
         B, C, H, W, D = input1.shape
 
         data_time.update(time.time() - end)
+        step_timer.start()
 
-        x1 = input1.float()  # Crop 1
-        x2 = input2.float()  # Crop 2
+        x1 = input1.to(dtype=torch.float, memory_format=memory_format)
+        x2 = input2.to(dtype=torch.float, memory_format=memory_format)
 
-        if not args.cpu:
-            x1 = x1.cuda()
-            x2 = x2.cuda()
-            gt1 = gt1.cuda()
-            gt2 = gt2.cuda()
-            crop1_coords = crop1_coords.cuda()
-            crop2_coords = crop2_coords.cuda()
-
-        # Get embeddings and predictions
-        emb1, pred1 = model(x1)
-        emb2, pred2 = model(x2)
-
-        # Normalize D dimension (BxNxD)
-        emb1 = nn.functional.normalize(emb1, dim=2, p=2)  
-        emb2 = nn.functional.normalize(emb2, dim=2, p=2) 
-
-        # Get ground truths (teacher predictions)
-        with torch.no_grad():
-            # Get prototypes and normalize
-            proto = model.module.prototypes.weight.data.clone()
-            proto = nn.functional.normalize(proto, dim=1, p=2)  # Normalize D dimension (KxD)
+        with autocast(device_type=device_type, dtype=amp_dtype, enabled=args.amp):  # Run the forwards and losses in mixed precision
+            # Get embeddings and predictions
+            emb1, pred1 = net(x1)
+            emb2, pred2 = net(x2)
 
-            # Embedding to prototype similarity matrix
-            cos_sim1 = torch.matmul(emb1, proto.t())  # BxNxK
-            cos_sim2 = torch.matmul(emb2, proto.t())
+            # Normalize D dimension (BxNxD)
+            emb1 = nn.functional.normalize(emb1, dim=2, p=2)  
+            emb2 = nn.functional.normalize(emb2, dim=2, p=2) 
 
-            N = cos_sim1.shape[1]  # Number of patches
-            P = model.module.patch_size  # Patch size
-            HP, WP, DP = (H//P, W//P, D//P)  # Grid of patches dims
-            K = model.module.proto_num  # Clusters
+            # Get ground truths (teacher predictions), in FP32 because exp overflows in half precision
+            with torch.no_grad(), autocast(device_type=device_type, enabled=False):
+                # Get prototypes and normalize (normalize returns a new tensor, so no clone is needed)
+                proto = nn.functional.normalize(model.module.prototypes.weight, dim=1, p=2)  # Normalize D dimension (KxD)
 
-            # Flatten batch and patch num dimensions of similarity matrices (BxNxK -> B*NxK), and transpose matrices (KxB*N) for sinkhorn algorithm
-            flat_cos_sim1 = cos_sim1.reshape(B*N,K).T
-            flat_cos_sim2 = cos_sim2.reshape(B*N,K).T
+                # Embedding to prototype similarity matrix (both crops in one matmul)
+                cos_sim1, cos_sim2 = torch.matmul(torch.cat((emb1, emb2), dim=0).float(), proto.t()).chunk(2, dim=0)  # BxNxK
 
-            # Standardize for numerical stability (maybe?)
-            eps = 0.05
-            flat_cos_sim1 = torch.exp(flat_cos_sim1 / eps)
-            flat_cos_sim2 = torch.exp(flat_cos_sim2 / eps)
+                N = cos_sim1.shape[1]  # Number of patches
+                P = model.module.patch_size  # Patch size
+                HP, WP, DP = (H//P, W//P, D//P)  # Grid of patches dims
+                K = model.module.proto_num  # Clusters
 
-            # Teacher cluster assignments
-            gt1 = sinkhorn(args, Q=flat_cos_sim1, nmb_iters=3).T.reshape((B,N,K))  # Also restore patch num dimension
-            gt2 = sinkhorn(args, Q=flat_cos_sim2, nmb_iters=3).T.reshape((B,N,K))
+                # Teacher cluster assignments (the similarity matrices are flattened to KxB*N, scaled with exp(cos_sim / eps) and balanced with sinkhorn)
+                gt1 = sinkhorn_codes(args, cos_sim1, eps=0.05, nmb_iters=3).reshape((B,N,K))  # Also restore patch num dimension
+                gt2 = sinkhorn_codes(args, cos_sim2, eps=0.05, nmb_iters=3).reshape((B,N,K))
 
-            # Apply temperature
-            temp = 1
-            gt1 = gt1 / temp
-            gt2 = gt2 / temp
+                # Apply temperature
+                temp = 1
+                gt1 = gt1 / temp
+                gt2 = gt2 / temp
 
-        # Convert to probabilities
-        pred1 = pred1.softmax(2)
-        pred2 = pred2.softmax(2)
+            # Convert to log-probabilities (for a stable cross-entropy)
+            pred1 = pred1.log_softmax(2)
+            pred2 = pred2.log_softmax(2)
 
-        # Convert prediction and ground truth to (soft) cluster masks (restore spatial position of pooled image)
-        pred1 = pred1.permute(0,2,1).reshape((B,K,HP,WP,DP))
-        pred2 = pred2.permute(0,2,1).reshape((B,K,HP,WP,DP))
-        gt1 = gt1.permute(0,2,1).reshape((B,K,HP,WP,DP))
-        gt2 = gt2.permute(0,2,1).reshape((B,K,HP,WP,DP))
+            # Convert prediction and ground truth to (soft) cluster masks (restore spatial position of pooled image)
+            pred1 = pred1.permute(0,2,1).reshape((B,K,HP,WP,DP))
+            pred2 = pred2.permute(0,2,1).reshape((B,K,HP,WP,DP))
+            gt1 = gt1.permute(0,2,1).reshape((B,K,HP,WP,DP))
+            gt2 = gt2.permute(0,2,1).reshape((B,K,HP,WP,DP))
 
-        # ROI-align crop intersection with cluster assignment intersection
-        roi_pred1, roi_pred2, roi_gt1, roi_gt2 = roi_align_intersect(pred1, pred2, gt1, gt2, crop1_coords, crop2_coords)
+            # ROI-align crop intersection with cluster assignment intersection
+            roi_pred1, roi_pred2, roi_gt1, roi_gt2 = roi_align_intersect(pred1, pred2, gt1, gt2, crop1_coords, crop2_coords)
 
-        # SwAV Loss for current scale
-        cluster_loss = swav_loss(roi_gt1, roi_gt2, roi_pred1, roi_pred2)
+            # SwAV Loss for current scale
+            cluster_loss = swav_loss(roi_gt1, roi_gt2, roi_pred1, roi_pred2)
 
         # Plot predictions on tensorboard
         with torch.no_grad():
             b_idx = 0
-            if args.vis and idx==b_idx: #and epoch % 10 == 0:
+            if args.vis and writer and idx==b_idx and epoch % args.vis_every == 0:
 
                 # Select 2D images
                 img_idx = 0
@@ -570,51 +597,17 @@ def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, write
                 gt1 = gt1[img_idx,:,:,:,gt1.size(-1)//2].argmax(dim=0).unsqueeze(0)
                 gt2 = gt2[img_idx,:,:,:,gt2.size(-1)//2].argmax(dim=0).unsqueeze(0)
 
-                # Min-max norm input images
-                in1 = (in1 - in1.min())/(in1.max() - in1.min())
-                in2 = (in2 - in2.min())/(in2.max() - in2.min())
-
                 # Interpolate cluster masks to original input shape
-                pred1 = f.interpolate(pred1.float().unsqueeze(0), size=(H,W)).squeeze(0)
-                pred2 = f.interpolate(pred2.float().unsqueeze(0), size=(H,W)).squeeze(0)
-                gt1 = f.interpolate(gt1.float().unsqueeze(0), size=(H,W)).squeeze(0)
-                gt2 = f.interpolate(gt2.float().unsqueeze(0), size=(H,W)).squeeze(0)
-
-                # Give color to each cluster in cluster masks
-                pred1 = pred1.repeat((3,1,1)).permute(1,2,0)  # Convert to RGB and move channel dim to the end
-                pred2 = pred2.repeat((3,1,1)).permute(1,2,0)
-                gt1 = gt1.repeat((3,1,1)).permute(1,2,0)
-                gt2 = gt2.repeat((3,1,1)).permute(1,2,0)
-                for c in range(colors.shape[0]):
-                    pred1[pred1[:,:,0] == c] = colors[c]
-                    pred2[pred2[:,:,0] == c] = colors[c]
-                    gt1[gt1[:,:,0] == c] = colors[c]
-                    gt2[gt2[:,:,0] == c] = colors[c]
-                pred1 = pred1.permute(2,0,1)
-                pred2 = pred2.permute(2,0,1)
-                gt1 = gt1.permute(2,0,1)
-                gt2 = gt2.permute(2,0,1)
-
-                # Pad images for better visualization                
-                in1 = f.pad(in1.unsqueeze(0),(2,1,2,2),value=1)
-                in2 = f.pad(in2.unsqueeze(0),(1,2,2,2),value=1)
-                pred1 = f.pad(pred1.unsqueeze(0),(2,1,2,2),value=1)
-                pred2 = f.pad(pred2.unsqueeze(0),(1,2,2,2),value=1)
-                gt1 = f.pad(gt1.unsqueeze(0),(2,1,2,2),value=1)
-                gt2 = f.pad(gt2.unsqueeze(0),(1,2,2,2),value=1)
-
-                # Combine crops and save in tensorboard
-                in_img = torch.cat((in1,in2),dim=3).squeeze(0)
-                pred_img = torch.cat((pred1,pred2),dim=3).squeeze(0)
-                gt_img = torch.cat((gt1,gt2),dim=3).squeeze(0).cpu()
-
-                in_img_name = 'img/train/raw' 
-                pred_img_name = f'img/train/pred'
-                gt_img_name = f'img/train/gt'
-
-                writer.add_image(in_img_name, img_tensor=in_img.cpu().detach().numpy(), global_step=epoch, dataformats='CHW')
-                writer.add_image(pred_img_name, img_tensor=pred_img.cpu().detach().numpy(), global_step=epoch, dataformats='CHW')   
-                writer.add_image(gt_img_name, img_tensor=gt_img.cpu().detach().numpy(), global_step=epoch, dataformats='CHW')
+                pred1 = f.interpolate(pred1.float().unsqueeze(0), size=(H,W))[0,0].long()
+                pred2 = f.interpolate(pred2.float().unsqueeze(0), size=(H,W))[0,0].long()
+                gt1 = f.interpolate(gt1.float().unsqueeze(0), size=(H,W))[0,0].long()
+                gt2 = f.interpolate(gt2.float().unsqueeze(0), size=(H,W))[0,0].long()
+
+                # Combine crops
+                in_img, pred_img, gt_img = render(in1, in2, pred1, pred2, gt1, gt2, colors)
+
+                # Save in tensorboard (copied and logged in the background, without waiting for the GPU)
+                writer.add_images_async({'img/train/raw': in_img, 'img/train/pred': pred_img, 'img/train/gt': gt_img}, epoch)
 
         # TODO: add the other losses later
         loss1 = cluster_loss
@@ -627,21 +620,23 @@ def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, write
         loss = loss1
 
         # Backward
-        if loss > 1000 and epoch > 10:
-            print('skip the step')
+        if epoch > 10 and any_process(loss > 1000):
+            if is_main_process():
+                print('skip the step')
             continue
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # Meters
-        mg_loss_meter.update(loss1.item(), B)
-        loss_meter.update(loss2.item(), B)
+        mg_loss_meter.update(loss1, B)
+        loss_meter.update(loss2, B)
         prob_meter.update(local_loss, B)
         total_loss_meter.update(loss, B)
-        if not args.cpu:
-            torch.cuda.synchronize()
-        batch_time.update(time.time() - end)
+        step_timer.stop()
+        if (idx + 1) % 10 == 0:
+            batch_time.update(step_timer.elapsed())
         end = time.time()
 
         # if args.tensorboard:
@@ -650,7 +645,7 @@ def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, write
         #         writer.add_graph(model_wrapper, x1)
 
         # print info
-        if (idx + 1) % 10 == 0:
+        if (idx + 1) % 10 == 0 and is_main_process():
             print('Train: [{0}][{1}/{2}]\t'
                   'BT {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'DT {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -661,11 +656,13 @@ def train_cluster_patch_inner(args, epoch, train_loader, model, optimizer, write
                 data_time=data_time, c2l_loss=loss_meter, mg_loss=mg_loss_meter, prob=prob_meter))
             sys.stdout.flush()
 
-    return mg_loss_meter.avg, prob_meter.avg, total_loss_meter.avg, writer
+    return mg_loss_meter.avg, prob_meter.avg, total_loss_meter.all_reduce().avg, writer
 
 
 def val_cluster_patch_inner(args, epoch, val_loader, model, colors, N):
 
+    memory_format = input_memory_format(args)
+
     with torch.no_grad():
 
         model.eval()
@@ -681,22 +678,20 @@ def val_cluster_patch_inner(args, epoch, val_loader, model, colors, N):
             # Keep only modality 0
             image = image[:,0:1,:,:,:]
 
-            x = image.float()
+            x = image
 
             if not args.cpu:
-                x = x.cuda()
+                x = x.cuda(non_blocking=True)
+            x = x.to(dtype=torch.float, memory_format=memory_format)
 
-            # Get embeddings and predictions
-            _, pred = model(x)
+            # Get embeddings and predictions (with the unwrapped model, because only the main process validates)
+            _, pred = model.module(x)
 
             grid_pred = []  # Contains the grid predictions of a specific scale
 
             P = model.module.patch_size
 
-            # Convert to probabilities
-            pred = pred.softmax(2)
-
-            # Convert prediction to (soft) cluster masks (restore spatial position of pooled image)
+            # Convert prediction logits to cluster masks (restore spatial position of pooled image), no softmax because only the argmax is shown
             HP = H//P  # Num patches at X
             WP = W//P  # Num patches at Y
             DP = D//P  # Num patches at Z
@@ -715,9 +710,7 @@ def val_cluster_patch_inner(args, epoch, val_loader, model, colors, N):
                 for img_idx in range(n_images): # If next epochs, add the predictions for each image at the current epoch as the next row
                     pred_i = pred[img_idx,:,:,:,DP//2].argmax(dim=0).unsqueeze(0)  # Take only hard cluster assignment (argmax)
                     pred_i = f.interpolate(pred_i.float().unsqueeze(0), size=(H,W)).squeeze(0)
-                    pred_i = pred_i.repeat((3,1,1)).permute(1,2,0).float()  # Convert to RGB and move channel dim to the end
-                    for c in range(colors.shape[0]):  # Give color to each cluster in cluster masks
-                        pred_i[pred_i[:,:,0] == c] = colors[c]
+                    pred_i = colors[pred_i[0].long()]  # Give color to each cluster in cluster masks (H x W -> H x W x 3, channel dim at the end)
                     pred_i = pred_i.cpu().detach()
                     grid_pred.append(pred_i)
                 